@@ -2,24 +2,33 @@
 Telegram 机器人主模块
 """
 from loguru import logger
+import asyncio
+import re
+import signal
 import sys
-from datetime import datetime
+import tempfile
+import time
+from datetime import datetime, timedelta
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
 
 # 导入自定义模块
-from app.config.settings import TELEGRAM_BOT_TOKEN, INVITE_CODE_EXPIRY_DAYS, INSTANCE_NAME
+from app.config.settings import (
+    TELEGRAM_BOT_TOKEN, REDIS_URL, MISSKEY_INSTANCES, PRIMARY_INSTANCE_ID,
+    STATS_ROLLUP_INTERVAL_SECONDS, EXPORT_MAX_DAYS, SHUTDOWN_DRAIN_TIMEOUT_SECONDS,
+    PENDING_REPLAY_DELAY_SECONDS, PENDING_REPLAY_MAX_ATTEMPTS, HISTORY_COMPACTION_INTERVAL_SECONDS,
+    CAPTCHA_BAN_SECONDS, LOOP_LAG_THRESHOLD_MS, PROFILE_MAX_SECONDS, PROFILE_SAMPLE_INTERVAL_MS,
+    REDIS_RECOVERY_CHECK_SECONDS, ADMIN_IDS, ADMINS_CHANNEL, ADMIN_RESYNC_INTERVAL_SECONDS
+)
 from app.utils import captcha_generator as captcha
+from app.utils import lifecycle
+from app.utils import profiler
 from app.services import database as db
+from app.services import events
 from app.services import misskey_api as misskey
-
-# 配置 loguru 日志
-logger.remove()
-logger.add(sys.stderr, level="INFO")  # 控制台输出
-logger.add("logs/info.log", rotation="1 week", retention="1 month", level="INFO")  # 信息日志
-logger.add("logs/error.log", rotation="1 week", retention="1 month", level="ERROR")  # 错误日志
-logger.add("logs/debug.log", rotation="1 week", retention="1 month", level="DEBUG")  # 调试日志
-logger.add("logs/all.log", rotation="1 week", retention="1 month")  # 所有日志
+from app.services import resilience
+from app.services import stats_export
+from app.services import throttle
 
 # 用户状态
 USER_STATES = {}
@@ -27,6 +36,32 @@ USER_STATES = {}
 STATE_IDLE = 'idle'
 STATE_WAITING_FOR_CAPTCHA = 'waiting_for_captcha'
 
+# 邀请码签发状态：已接受请求、已在 Misskey 生成、已记录到数据库
+PENDING_ACCEPTED = 'accepted'
+PENDING_MINTED = 'minted'
+PENDING_RECORDED = 'recorded'
+
+# 等待验证码的用户所选择的实例
+USER_INSTANCES = {}
+
+# 后台任务
+BACKGROUND_TASKS = []
+
+# 正在进行的性能采样，同一时间只允许一个
+PROFILE_TASK = None
+
+def instance_names():
+    """所有实例的名称，用于欢迎和帮助信息"""
+    return "、".join(instance['name'] for instance in MISSKEY_INSTANCES.values())
+
+def build_instance_picker():
+    """构建实例选择键盘"""
+    keyboard = [
+        [InlineKeyboardButton(f"🌐 {instance['name']}", callback_data=f"pick_instance:{instance_id}")]
+        for instance_id, instance in MISSKEY_INSTANCES.items()
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
 # 命令处理函数
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """处理 /start 命令"""
@@ -39,6 +74,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         user.first_name, 
         user.last_name
     )
+    db.record_event('start', user.id)
     
     # 检查是否为管理员
     is_admin = db.is_admin(user.id)
@@ -46,7 +82,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     # 基本欢迎消息
     welcome_text = (
         f"你好，{user.first_name}！👋\n\n"
-        f"我是 {INSTANCE_NAME} 邀请码机器人。我可以帮你获取 {INSTANCE_NAME} 实例的邀请码。\n\n"
+        f"我是 {instance_names()} 邀请码机器人。我可以帮你获取 {instance_names()} 实例的邀请码。\n\n"
         "可用命令：\n"
         "/invite - 获取邀请码\n"
         "/history - 查看邀请码历史\n"
@@ -65,10 +101,14 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         welcome_text += admin_text
     
     # 创建内联键盘
-    keyboard = [
-        [InlineKeyboardButton("🌐 访问实例", url=misskey.get_instance_url())],
-        [InlineKeyboardButton("📋 获取邀请码", callback_data="get_invite")]
-    ]
+    if len(MISSKEY_INSTANCES) == 1:
+        keyboard = [[InlineKeyboardButton("🌐 访问实例", url=misskey.get_instance_url(PRIMARY_INSTANCE_ID))]]
+    else:
+        keyboard = [
+            [InlineKeyboardButton(f"🌐 访问 {instance['name']}", url=misskey.get_instance_url(instance_id))]
+            for instance_id, instance in MISSKEY_INSTANCES.items()
+        ]
+    keyboard.append([InlineKeyboardButton("📋 获取邀请码", callback_data="get_invite")])
     reply_markup = InlineKeyboardMarkup(keyboard)
     
     # 发送欢迎消息
@@ -87,8 +127,8 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         "📚 帮助信息 📚\n\n"
         "可用命令:\n"
         "/start - 开始使用机器人\n"
-        f"/invite - 获取 {INSTANCE_NAME} 邀请码\n"
-        "/history - 查看你的邀请码历史\n"
+        f"/invite [实例 ID] - 获取 {instance_names()} 邀请码\n"
+        "/history [实例 ID] [YYYY-MM] - 查看你的邀请码历史，带月份时查看归档\n"
         "/info - 查看你的用户信息\n"
         "/help - 显示此帮助信息\n\n"
     )
@@ -99,7 +139,14 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         help_text += (
             "管理员命令:\n"
             "/admin - 管理员菜单\n"
-            "/stats - 查看邀请码统计\n\n"
+            "/stats [天数|Nw|Nm] - 查看邀请码统计，如 /stats 12w、/stats 6m\n"
+            "/chart [天数|Nw|Nm] - 查看邀请码趋势图\n"
+            "/export [开始日期] [结束日期] - 导出统计 CSV，日期格式 YYYY-MM-DD\n"
+            "/profile [秒数] - 对运行中的机器人采样，返回热点函数和火焰图数据\n"
+            "/health - 查看 Redis 连接和降级运行状态\n"
+            "/admins - 查看管理员列表\n"
+            "/addadmin <用户ID> - 添加管理员\n"
+            "/deladmin <用户ID> - 移除管理员\n\n"
             
             "获取邀请码流程 (管理员):\n"
             "1. 发送 /invite 命令\n"
@@ -110,6 +157,8 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         )
     else:
         # 普通用户流程 - 只有普通用户可以看到
+        expiry_days = "/".join(sorted({str(instance['invite_expiry_days'])
+                                       for instance in MISSKEY_INSTANCES.values()}))
         help_text += (
             "获取邀请码流程:\n"
             "1. 发送 /invite 命令\n"
@@ -117,7 +166,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
             "3. 获取邀请码\n\n"
             "注意:\n"
             "- 每个用户每周只能获取一次邀请码\n"
-            f"- 邀请码有效期为 {INVITE_CODE_EXPIRY_DAYS} 天\n"
+            f"- 邀请码有效期为 {expiry_days} 天\n"
         )
     
     await update.message.reply_text(help_text)
@@ -125,13 +174,15 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 async def info_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """处理 /info 命令 - 显示用户信息"""
     user = update.effective_user
-    user_data = db.get_user(user.id) or {}
+    # 用户信息和邀请码历史在一次往返中读取
+    user_data, history, archive_index = db.get_user_profile(user.id)
+    user_data = user_data or {}
     
     # 获取注册时间
     registered_at = "未知"
     if user_data and 'registered_at' in user_data:
         try:
-            registered_at = datetime.fromisoformat(user_data['registered_at']).strftime('%Y-%m-%d %H:%M')
+            registered_at = datetime.fromtimestamp(user_data['registered_at']).strftime('%Y-%m-%d %H:%M')
         except (ValueError, TypeError):
             pass
     
@@ -157,25 +208,28 @@ async def info_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     else:
         info_text += "\n"
     
-    # 获取邀请码历史统计
-    history = db.get_user_invite_history(user.id)
+    # 邀请码历史统计
     total_invites = len(history)
     
     # 计算有效邀请码数量
+    now = time.time()
     valid_invites = 0
     for record in history:
         if record.get('expires_at') is None:  # 永久有效
             valid_invites += 1
-        elif datetime.now() < datetime.fromisoformat(record['expires_at']):
+        elif now < record['expires_at']:
             valid_invites += 1
     
     # 添加邀请码统计信息
+    archived_invites = sum(archive_index.values())
     info_text += (
         "邀请码统计:\n"
-        f"总计: {total_invites} 个\n"
+        f"总计: {total_invites + archived_invites} 个\n"
         f"有效: {valid_invites} 个\n"
         f"已过期: {total_invites - valid_invites} 个\n"
     )
+    if archived_invites:
+        info_text += f"已归档: {archived_invites} 个\n"
     
     await update.message.reply_text(info_text)
 
@@ -201,6 +255,97 @@ async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         reply_markup=reply_markup
     )
 
+async def admins_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """处理 /admins 命令 - 列出管理员"""
+    user_id = update.effective_user.id
+    
+    # 检查是否为管理员
+    if not db.is_admin(user_id):
+        await update.message.reply_text("⚠️ 你不是管理员，无法使用此命令。")
+        return
+    
+    admins_text = "👑 管理员列表 👑\n\n"
+    for admin_id, from_config in db.get_admins():
+        user = db.get_user(admin_id) or {}
+        name = f"@{user['username']}" if user.get('username') else user.get('first_name', '未知用户')
+        admins_text += f"{admin_id} {name}" + ("（配置）" if from_config else "") + "\n"
+    admins_text += "\n使用 /addadmin <用户ID> 添加管理员，/deladmin <用户ID> 移除管理员"
+    
+    await update.message.reply_text(admins_text)
+
+def parse_admin_target(args):
+    """解析管理员命令中的用户 ID，格式不正确时返回 None"""
+    if len(args) != 1 or not args[0].isdigit():
+        return None
+    return int(args[0])
+
+async def addadmin_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """处理 /addadmin 命令 - 添加管理员，所有副本立即生效"""
+    user_id = update.effective_user.id
+    
+    # 检查是否为管理员
+    if not db.is_admin(user_id):
+        await update.message.reply_text("⚠️ 你不是管理员，无法使用此命令。")
+        return
+    
+    target_id = parse_admin_target(context.args)
+    if target_id is None:
+        await update.message.reply_text("⚠️ 参数格式不正确，请使用 /addadmin <用户ID>")
+        return
+    if db.is_admin(target_id):
+        await update.message.reply_text(f"用户 {target_id} 已经是管理员。")
+        return
+    
+    db.add_admin(target_id)
+    logger.info(f"管理员 {user_id} 添加了管理员 {target_id}")
+    await update.message.reply_text(f"✅ 已将用户 {target_id} 设为管理员。")
+
+async def deladmin_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """处理 /deladmin 命令 - 移除管理员，所有副本立即生效"""
+    user_id = update.effective_user.id
+    
+    # 检查是否为管理员
+    if not db.is_admin(user_id):
+        await update.message.reply_text("⚠️ 你不是管理员，无法使用此命令。")
+        return
+    
+    target_id = parse_admin_target(context.args)
+    if target_id is None:
+        await update.message.reply_text("⚠️ 参数格式不正确，请使用 /deladmin <用户ID>")
+        return
+    if target_id in ADMIN_IDS:
+        await update.message.reply_text(f"⚠️ 用户 {target_id} 是配置中的管理员，请修改 ADMIN_IDS 后重启。")
+        return
+    if not db.is_admin(target_id):
+        await update.message.reply_text(f"用户 {target_id} 不是管理员。")
+        return
+    
+    db.remove_admin(target_id)
+    logger.info(f"管理员 {user_id} 移除了管理员 {target_id}")
+    await update.message.reply_text(f"✅ 已移除用户 {target_id} 的管理员权限。")
+
+def parse_stats_range(args):
+    """
+    解析统计范围参数：纯数字或 Nd 为天，Nw 为周，Nm 为月
+    
+    返回:
+        tuple: (周期类型, 周期数量)
+    """
+    period, count = 'day', 7
+    if args:
+        match = re.fullmatch(r'(\d+)([dwm]?)', args[0].lower())
+        if match:
+            count = int(match.group(1))
+            period = {'': 'day', 'd': 'day', 'w': 'week', 'm': 'month'}[match.group(2)]
+    
+    if period == 'day':
+        count = min(count, 30)  # 最多显示30天
+    elif period == 'week':
+        count = min(count, 104)  # 最多显示104周
+    else:
+        count = min(count, 60)  # 最多显示60个月
+    return period, max(count, 1)
+
 async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """处理 /stats 命令 - 查看邀请码统计"""
     user_id = update.effective_user.id
@@ -210,15 +355,24 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         await update.message.reply_text("⚠️ 你不是管理员，无法使用此命令。")
         return
     
-    # 获取统计数据
-    days = 7
-    if context.args and context.args[0].isdigit():
-        days = min(int(context.args[0]), 30)  # 最多显示30天
+    period, count = parse_stats_range(context.args)
+    stats = stats_export.load_period_stats(period, count)
     
-    stats = db.get_invite_stats(days)
+    if period == 'day':
+        title = f"最近 {count} 天"
+        section_title = "每日统计:"
+        label_key = 'date'
+    elif period == 'week':
+        title = f"最近 {count} 周"
+        section_title = "每周统计:"
+        label_key = 'period'
+    else:
+        title = f"最近 {count} 个月"
+        section_title = "每月统计:"
+        label_key = 'period'
     
     # 生成统计报告
-    stats_text = f"📊 最近 {days} 天的邀请码统计 📊\n\n"
+    stats_text = f"📊 {title}的邀请码统计 📊\n\n"
     
     # 总计
     total_invites = sum(day['total_invites'] for day in stats)
@@ -230,33 +384,183 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         f"总邀请码数量: {total_invites}\n"
         f"管理员生成: {admin_invites}\n"
         f"普通用户生成: {user_invites}\n\n"
-        "每日统计:\n"
+        f"{section_title}\n"
     )
     
-    # 每日统计
+    # 分期统计
     for day in stats:
-        date = day['date']
+        label = day[label_key]
         total = day['total_invites']
         admin = day['admin_invites']
         user = day['user_invites']
         
         if total > 0:
-            stats_text += f"{date}: 总计 {total} (管理员: {admin}, 用户: {user})\n"
+            stats_text += f"{label}: 总计 {total} (管理员: {admin}, 用户: {user})\n"
+    
+    # 按天查看时附带用户活动汇总
+    if period == 'day':
+        activity = db.get_activity_stats(count)
+        stats_text += (
+            "\n用户活动:\n"
+            f"/start: {activity.get('start', 0)} 次\n"
+            f"验证码: 发出 {activity.get('captcha_issued', 0)}，"
+            f"通过 {activity.get('captcha_passed', 0)}，"
+            f"失败 {activity.get('captcha_failed', 0)}，"
+            f"限流 {activity.get('captcha_throttled', 0)}\n"
+        )
     
     # 如果统计信息太长，可能需要分多条消息发送
     if len(stats_text) > 4000:
         await update.message.reply_text("⚠️ 统计信息太长，只显示总计信息。")
-        await update.message.reply_text(stats_text.split("每日统计:")[0])
+        await update.message.reply_text(stats_text.split(section_title)[0])
     else:
         await update.message.reply_text(stats_text)
 
+async def chart_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """处理 /chart 命令 - 查看邀请码趋势图"""
+    user_id = update.effective_user.id
+    
+    # 检查是否为管理员
+    if not db.is_admin(user_id):
+        await update.message.reply_text("⚠️ 你不是管理员，无法使用此命令。")
+        return
+    
+    period, count = parse_stats_range(context.args)
+    
+    try:
+        image = await stats_export.get_trend_chart(period, count)
+    except Exception as e:
+        logger.error(f"渲染统计图表时出错: {e}")
+        await update.message.reply_text("❌ 生成统计图表时出错，请稍后再试。")
+        return
+    
+    unit = {'day': '天', 'week': '周', 'month': '个月'}[period]
+    await update.message.reply_photo(
+        photo=image,
+        caption=f"📈 最近 {count} {unit}的邀请码趋势"
+    )
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """处理 /export 命令 - 导出邀请码统计 CSV"""
+    user_id = update.effective_user.id
+    
+    # 检查是否为管理员
+    if not db.is_admin(user_id):
+        await update.message.reply_text("⚠️ 你不是管理员，无法使用此命令。")
+        return
+    
+    # 解析日期范围，默认导出最近30天
+    today = datetime.now().date()
+    try:
+        start_date = datetime.strptime(context.args[0], '%Y-%m-%d').date() if context.args else today - timedelta(days=29)
+        end_date = datetime.strptime(context.args[1], '%Y-%m-%d').date() if len(context.args) > 1 else today
+    except ValueError:
+        await update.message.reply_text("⚠️ 日期格式不正确，请使用 /export YYYY-MM-DD [YYYY-MM-DD]")
+        return
+    
+    if start_date > end_date:
+        start_date, end_date = end_date, start_date
+    if (end_date - start_date).days >= EXPORT_MAX_DAYS:
+        await update.message.reply_text(f"⚠️ 单次最多导出 {EXPORT_MAX_DAYS} 天的统计。")
+        return
+    
+    # 每日统计只保留 STATS_RETENTION_DAYS 天，更早的日期按周汇总导出
+    notice = ""
+    daily_start = stats_export.daily_export_start(start_date)
+    if start_date < daily_start:
+        notice = f"\n{daily_start} 之前的统计按周汇总导出（period 列为 week）"
+    
+    # 逐行写入临时文件，超过内存阈值时落盘
+    with tempfile.SpooledTemporaryFile(max_size=1024 * 1024) as csv_file:
+        rows = await asyncio.to_thread(stats_export.write_stats_csv, start_date, end_date, csv_file)
+        await update.message.reply_document(
+            document=csv_file,
+            filename=f"invite_stats_{start_date}_{end_date}.csv",
+            caption=f"📄 {start_date} 至 {end_date} 的邀请码统计，共 {rows} 行数据" + notice
+        )
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """处理 /profile 命令 - 对运行中的机器人采样，返回热点函数和折叠栈文件"""
+    global PROFILE_TASK
+    user_id = update.effective_user.id
+    
+    # 检查是否为管理员
+    if not db.is_admin(user_id):
+        await update.message.reply_text("⚠️ 你不是管理员，无法使用此命令。")
+        return
+    
+    try:
+        seconds = int(context.args[0]) if context.args else 10
+    except ValueError:
+        await update.message.reply_text("⚠️ 参数格式不正确，请使用 /profile [秒数]")
+        return
+    if not 1 <= seconds <= PROFILE_MAX_SECONDS:
+        await update.message.reply_text(f"⚠️ 采样时间应在 1 到 {PROFILE_MAX_SECONDS} 秒之间。")
+        return
+    if PROFILE_TASK and not PROFILE_TASK.done():
+        await update.message.reply_text("⏳ 已有采样正在进行，请稍后再试。")
+        return
+    
+    await update.message.reply_text(f"🔬 开始采样 {seconds} 秒...")
+    # 更新按顺序处理，采样在后台进行，期间的请求才能被采到
+    PROFILE_TASK = asyncio.create_task(run_profile(update.message, seconds))
+    BACKGROUND_TASKS.append(PROFILE_TASK)
+    PROFILE_TASK.add_done_callback(lambda task: BACKGROUND_TASKS.remove(task) if task in BACKGROUND_TASKS else None)
+
+async def run_profile(message, seconds):
+    """在线程中采样，完成后发送热点列表和折叠栈文件"""
+    # 单独记录采样期间的事件循环延迟，不重置 /health 显示的全局最大值
+    lag = profiler.start_lag_window()
+    try:
+        stacks, rounds = await asyncio.to_thread(
+            profiler.sample_stacks, seconds, PROFILE_SAMPLE_INTERVAL_MS / 1000
+        )
+    finally:
+        profiler.end_lag_window(lag)
+    
+    report = (
+        f"🔬 采样完成：{seconds} 秒，{rounds} 轮，{sum(stacks.values())} 个非空闲样本\n"
+        f"事件循环最大延迟: {lag['max_ms']:.0f} ms，"
+        f"超过 {LOOP_LAG_THRESHOLD_MS} ms 的阻塞: {lag['stalls']} 次\n\n"
+    )
+    spots = profiler.hot_spots(stacks)
+    if not spots:
+        await message.reply_text(report + "采样期间所有线程都处于空闲状态。")
+        return
+    
+    report += "热点函数（自身 / 含子调用，占采样轮数的比例）:\n"
+    for location, own, total in spots:
+        report += f"{own * 100 / rounds:5.1f}% {total * 100 / rounds:5.1f}%  {location}\n"
+    await message.reply_text(report[:4000])
+    
+    await message.reply_document(
+        document=profiler.format_folded(stacks).encode('utf-8'),
+        filename=f"profile_{datetime.now().strftime('%Y%m%d_%H%M%S')}.folded",
+        caption="折叠栈文件，可用 flamegraph.pl 或 speedscope 生成火焰图"
+    )
+
 async def invite_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """处理 /invite 命令"""
+    """处理 /invite 命令，/invite <实例 ID> 直接选择实例"""
     user_id = update.effective_user.id
+    
+    if context.args and context.args[0] in MISSKEY_INSTANCES:
+        instance_id = context.args[0]
+    elif len(MISSKEY_INSTANCES) == 1:
+        instance_id = PRIMARY_INSTANCE_ID
+    else:
+        # 多个实例时先让用户选择
+        await update.message.reply_text("请选择要获取邀请码的实例：", reply_markup=build_instance_picker())
+        return
+    
+    await start_invite(update, user_id, instance_id)
+
+async def start_invite(update, user_id, instance_id, idempotency_key=None):
+    """为指定实例开始获取邀请码：管理员直接生成，普通用户先发送验证码"""
+    instance = MISSKEY_INSTANCES[instance_id]
     is_admin = db.is_admin(user_id)
     
     # 检查用户是否可以请求邀请码
-    if not is_admin and not db.can_request_invite_code(user_id):
+    if not is_admin and not db.can_request_invite_code(user_id, instance_id):
         await update.message.reply_text(
             "⚠️ 你已经在本周内获取过邀请码了，请等待下周再试。\n\n"
             "使用 /history 命令查看你的邀请码历史。"
@@ -265,47 +569,82 @@ async def invite_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     
     # 管理员直接获取邀请码，无需验证码
     if is_admin:
-        await update.message.reply_text(f"👑 管理员正在生成 {INSTANCE_NAME} 邀请码...")
-        await generate_invite_code(update, user_id, is_admin=True)
+        await update.message.reply_text(f"👑 管理员正在生成 {instance['name']} 邀请码...")
+        await generate_invite_code(
+            update, user_id, is_admin=True,
+            idempotency_key=idempotency_key, instance_id=instance_id
+        )
         return
     
     # 普通用户需要验证码
-    # 生成验证码
-    captcha_text, captcha_image = captcha.generate_captcha()
+    # 先检查限流，超限时不生成验证码图片
+    result, retry_after = throttle.check_captcha_issue(user_id)
+    if result:
+        db.record_event('captcha', user_id, result='throttled')
+        await update.message.reply_text(throttle_message(result, retry_after))
+        return
+    
+    # 生成验证码，渲染在线程中执行，避免阻塞事件循环
+    captcha_text, captcha_image = await asyncio.to_thread(captcha.generate_captcha)
     
     # 保存验证码到数据库
     db.save_captcha(user_id, captcha_text)
+    db.record_event('captcha', user_id, result='issued')
     
     # 更新用户状态
     USER_STATES[user_id] = STATE_WAITING_FOR_CAPTCHA
+    USER_INSTANCES[user_id] = instance_id
     
     # 发送验证码图片
     await update.message.reply_photo(
         photo=captcha_image,
-        caption=f"请输入上图中的验证码以获取 {INSTANCE_NAME} 邀请码。\n验证码有效期为5分钟。"
+        caption=f"请输入上图中的验证码以获取 {instance['name']} 邀请码。\n验证码有效期为5分钟。"
     )
 
 async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """处理 /history 命令"""
+    """处理 /history 命令，/history [实例 ID] [YYYY-MM] 按实例筛选或查看已归档的月份"""
     user_id = update.effective_user.id
     is_admin = db.is_admin(user_id)
     
-    # 获取用户的邀请码历史
-    history = db.get_user_invite_history(user_id)
-    
-    if not history:
-        await update.message.reply_text("你还没有获取过邀请码。")
-        return
+    # 默认合并所有实例的记录
+    instance_ids = list(MISSKEY_INSTANCES)
+    month = None
+    for arg in context.args or []:
+        if arg in MISSKEY_INSTANCES:
+            instance_ids = [arg]
+        elif re.fullmatch(r'\d{4}-\d{2}', arg):
+            month = arg
+        else:
+            await update.message.reply_text("⚠️ 参数不正确，请使用 /history [实例 ID] [YYYY-MM]")
+            return
     
-    # 构建历史记录消息
-    history_text = "📜 你的邀请码历史 📜\n\n"
+    # 查看归档的月份
+    if month:
+        history = [{**record, 'instance_id': instance_id} for instance_id in instance_ids
+                   for record in db.get_archived_history(user_id, month, instance_id)]
+        history.sort(key=lambda record: record['requested_at'])
+        if not history:
+            await update.message.reply_text(f"{month} 没有归档的邀请码记录。")
+            return
+        title = f"📦 {month} 归档的邀请码历史 📦\n\n"
+        archive_index = {}
+    else:
+        # 获取用户的邀请码历史（热数据）和归档索引
+        _, history, archive_index = db.get_user_profile(user_id, instance_ids)
+        if not history and not archive_index:
+            await update.message.reply_text("你还没有获取过邀请码。")
+            return
+        title = "📜 你的邀请码历史 📜\n\n"
     
+    # 构建历史记录
+    entries = []
     for i, record in enumerate(history, 1):
-        requested_at = datetime.fromisoformat(record['requested_at'])
+        requested_at = datetime.fromtimestamp(record['requested_at'])
         
         # 处理过期时间
+        is_expired = False
         if record.get('expires_at'):
-            expires_at = datetime.fromisoformat(record['expires_at'])
+            expires_at = datetime.fromtimestamp(record['expires_at'])
             # 检查是否已过期
             is_expired = datetime.now() > expires_at
             status = "❌ 已过期" if is_expired else "✅ 有效"
@@ -320,14 +659,50 @@ async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         if is_admin and record.get('is_admin_generated'):
             admin_mark = " 👑"
         
-        history_text += (
+        # 多个实例时注明邀请码所属的实例，有效的邀请码附带注册链接
+        instance_info = ""
+        instance_id = record['instance_id']
+        if len(MISSKEY_INSTANCES) > 1 and instance_id in MISSKEY_INSTANCES:
+            instance_info = f"实例: {MISSKEY_INSTANCES[instance_id]['name']}\n"
+            if not is_expired:
+                instance_info += f"注册链接: {misskey.get_invite_code_url(record['invite_code'], instance_id)}\n"
+        
+        entries.append(
             f"{i}. 邀请码: {record['invite_code']}{admin_mark}\n"
+            f"{instance_info}"
             f"获取时间: {requested_at.strftime('%Y-%m-%d %H:%M')}\n"
             f"{expiry_info}"
             f"状态: {status}\n\n"
         )
     
-    await update.message.reply_text(history_text)
+    # 列出归档的月份
+    footer = ""
+    if archive_index:
+        months = sorted(archive_index, reverse=True)
+        footer = "📦 已归档的记录:\n" + "".join(
+            f"{month}: {archive_index[month]} 条\n" for month in months[:12]
+        )
+        if len(months) > 12:
+            footer += f"... 共 {len(months)} 个月\n"
+        footer += f"使用 /history {months[0]} 查看归档记录"
+    
+    # 消息太长时只显示最近的记录
+    omitted = 0
+    while entries and len(title) + sum(map(len, entries)) + len(footer) > 4000:
+        entries.pop(0)
+        omitted += 1
+    if omitted:
+        title += f"（仅显示最近 {len(entries)} 条）\n\n"
+    
+    await update.message.reply_text(title + "".join(entries) + footer)
+
+def throttle_message(result, retry_after):
+    """生成限流提示"""
+    if result == throttle.BANNED:
+        return f"⛔ 验证失败次数过多，请在 {(retry_after + 59) // 60} 分钟后再试。"
+    if result == throttle.COOLDOWN:
+        return f"⏳ 获取验证码过于频繁，请在 {retry_after} 秒后再试。"
+    return "⏳ 当前请求较多，请稍后再试。"
 
 async def handle_captcha_response(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """处理用户输入的验证码"""
@@ -338,12 +713,29 @@ async def handle_captcha_response(update: Update, context: ContextTypes.DEFAULT_
         return
     
     captcha_text = update.message.text.strip()
+    instance_id = USER_INSTANCES.get(user_id, PRIMARY_INSTANCE_ID)
+    
+    # 检查限流，封禁期间或全局繁忙时不进行校验
+    result, retry_after = throttle.check_captcha_verify(user_id)
+    if result:
+        db.record_event('captcha', user_id, result='throttled')
+        await update.message.reply_text(throttle_message(result, retry_after))
+        if result == throttle.BANNED:
+            USER_STATES[user_id] = STATE_IDLE
+            USER_INSTANCES.pop(user_id, None)
+        return
     
     # 验证验证码
-    if db.verify_captcha(user_id, captcha_text):
+    verified = db.verify_captcha(user_id, captcha_text)
+    db.record_event('captcha', user_id, result='passed' if verified else 'failed')
+    if verified:
         # 验证成功，创建邀请码
+        throttle.reset_captcha_failures(user_id)
         await update.message.reply_text("✅ 验证码正确！正在为你生成邀请码...")
-        await generate_invite_code(update, user_id)
+        await generate_invite_code(update, user_id, instance_id=instance_id)
+    elif throttle.record_captcha_failure(user_id):
+        # 失败次数过多，临时封禁
+        await update.message.reply_text(throttle_message(throttle.BANNED, CAPTCHA_BAN_SECONDS))
     else:
         # 验证失败
         await update.message.reply_text(
@@ -353,58 +745,157 @@ async def handle_captcha_response(update: Update, context: ContextTypes.DEFAULT_
     
     # 重置用户状态
     USER_STATES[user_id] = STATE_IDLE
+    USER_INSTANCES.pop(user_id, None)
 
-async def generate_invite_code(update, user_id, is_admin=False):
-    """生成邀请码并发送给用户"""
-    # 调用 Misskey API 创建邀请码
-    invite_data = misskey.create_invite_code(is_admin=is_admin)
+def build_invite_message(invite_data, is_admin=False, instance_id=PRIMARY_INSTANCE_ID):
+    """
+    构建发送给用户的邀请码消息
     
-    if invite_data and 'code' in invite_data:
-        # 记录邀请码请求
-        record = db.record_invite_code_request(
-            user_id, 
-            invite_data['code'], 
-            INVITE_CODE_EXPIRY_DAYS if not is_admin else None
-        )
-        
-        # 获取邀请链接
-        invite_url = misskey.get_invite_code_url(invite_data['code'])
-        
-        # 构建邀请码消息
-        invite_message = "🎉 邀请码生成成功 🎉\n\n"
-        
-        # 添加管理员标记
-        if is_admin:
-            invite_message += "👑 管理员生成的永久邀请码\n\n"
-        
-        invite_message += f"邀请码: {invite_data['code']}\n\n"
-        
-        # 处理过期时间
-        if invite_data.get('expires_at'):
-            expires_at = datetime.fromisoformat(invite_data['expires_at'])
-            invite_message += f"过期时间: {expires_at.strftime('%Y-%m-%d %H:%M')}\n\n"
-        else:
-            invite_message += "过期时间: 永不过期\n\n"
+    返回:
+        tuple: (消息文本, 内联键盘)
+    """
+    # 获取邀请链接
+    invite_url = misskey.get_invite_code_url(invite_data['code'], instance_id)
+    
+    # 构建邀请码消息
+    invite_message = "🎉 邀请码生成成功 🎉\n\n"
+    
+    # 多个实例时标明所属实例
+    if len(MISSKEY_INSTANCES) > 1:
+        invite_message += f"实例: {MISSKEY_INSTANCES[instance_id]['name']}\n\n"
+    
+    # 添加管理员标记
+    if is_admin:
+        invite_message += "👑 管理员生成的永久邀请码\n\n"
+    
+    invite_message += f"邀请码: {invite_data['code']}\n\n"
+    
+    # 处理过期时间
+    if invite_data.get('expires_at'):
+        expires_at = datetime.fromisoformat(invite_data['expires_at'])
+        invite_message += f"过期时间: {expires_at.strftime('%Y-%m-%d %H:%M')}\n\n"
+    else:
+        invite_message += "过期时间: 永不过期\n\n"
+    
+    invite_message += f"注册链接: {invite_url}\n\n"
+    invite_message += "请在过期前使用此邀请码。" if invite_data.get('expires_at') else "此邀请码永不过期。"
+    
+    # 创建内联键盘
+    keyboard = [
+        [InlineKeyboardButton("📋 复制邀请码", callback_data=f"copy_{invite_data['code']}")],
+        [InlineKeyboardButton("🔗 打开注册链接", url=invite_url)]
+    ]
+    return invite_message, InlineKeyboardMarkup(keyboard)
+
+async def process_pending_invite(bot, token, pending, notice=""):
+    """
+    按签发记录的状态继续处理：调用 Misskey API、记录邀请码、发送给用户
+    
+    每完成一步都会更新 Redis 中的签发记录，进程在任意一步中断后，
+    重启时都可以从中断处继续，不会丢失已经在 Misskey 上生成的邀请码。
+    """
+    chat_id = pending['chat_id']
+    user_id = pending['user_id']
+    is_admin = pending['is_admin']
+    # 多实例支持之前保存的签发记录没有实例 ID
+    instance_id = pending.get('instance_id', PRIMARY_INSTANCE_ID)
+    
+    if pending['state'] == PENDING_ACCEPTED:
+        db.save_pending_invite(token, pending)
         
-        invite_message += f"注册链接: {invite_url}\n\n"
-        invite_message += "请在过期前使用此邀请码。" if invite_data.get('expires_at') else "此邀请码永不过期。"
+        # 调用 Misskey API 创建邀请码，在线程中执行，避免阻塞事件循环
+        invite_data = await asyncio.to_thread(
+            misskey.create_invite_code, is_admin=is_admin, instance_id=instance_id
+        )
         
-        # 创建内联键盘
-        keyboard = [
-            [InlineKeyboardButton("📋 复制邀请码", callback_data=f"copy_{invite_data['code']}")],
-            [InlineKeyboardButton("🔗 打开注册链接", url=invite_url)]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        if not invite_data or not invite_data.get('code'):
+            db.delete_pending_invite(token)
+            db.release_idempotent_request(token)
+            await bot.send_message(
+                chat_id=chat_id,
+                text="❌ 生成邀请码时出错，请稍后再试或联系管理员。"
+            )
+            return
         
-        await update.message.reply_text(
-            invite_message,
-            reply_markup=reply_markup,
-            disable_web_page_preview=True
-        )
-    else:
-        await update.message.reply_text(
-            "❌ 生成邀请码时出错，请稍后再试或联系管理员。"
+        pending.update(state=PENDING_MINTED, invite_data=invite_data, updated_at=time.time())
+        db.save_pending_invite(token, pending)
+    
+    if pending['state'] == PENDING_MINTED:
+        # 记录邀请码请求
+        db.record_invite_code_request(
+            user_id,
+            pending['invite_data']['code'],
+            MISSKEY_INSTANCES[instance_id]['invite_expiry_days'] if not is_admin else None,
+            instance_id,
+            requested_at=int(time.time())
         )
+        pending.update(state=PENDING_RECORDED, updated_at=time.time())
+        db.save_pending_invite(token, pending)
+        db.complete_idempotent_request(token, {
+            'invite_data': pending['invite_data'],
+            'is_admin': is_admin,
+            'instance_id': instance_id
+        })
+    
+    invite_message, reply_markup = build_invite_message(pending['invite_data'], is_admin, instance_id)
+    await bot.send_message(
+        chat_id=chat_id,
+        text=notice + invite_message,
+        reply_markup=reply_markup,
+        disable_web_page_preview=True
+    )
+    db.delete_pending_invite(token)
+
+async def generate_invite_code(update, user_id, is_admin=False, idempotency_key=None,
+                               instance_id=PRIMARY_INSTANCE_ID):
+    """
+    生成邀请码并发送给用户
+    
+    幂等键默认由消息的会话 ID 和消息 ID 生成，Telegram 重复投递同一更新时保持不变；
+    重复的请求不会再次调用 Misskey API，而是直接返回首次生成的邀请码。
+    """
+    message = update.message
+    bot = message.get_bot()
+    idempotency_key = idempotency_key or f"msg:{message.chat_id}:{message.message_id}"
+    
+    existing = db.begin_idempotent_request(idempotency_key)
+    if existing:
+        logger.info(f"重复的邀请码请求 {idempotency_key}，状态 {existing['state']}")
+        if existing['state'] == 'done':
+            invite_message, reply_markup = build_invite_message(
+                existing['invite_data'], existing['is_admin'],
+                existing.get('instance_id', PRIMARY_INSTANCE_ID)
+            )
+            await bot.send_message(
+                chat_id=message.chat_id,
+                text="ℹ️ 该请求已处理过，以下是之前生成的邀请码：\n\n" + invite_message,
+                reply_markup=reply_markup,
+                disable_web_page_preview=True
+            )
+        else:
+            await bot.send_message(chat_id=message.chat_id, text="⏳ 该请求正在处理中，请稍候。")
+        return
+    
+    lock = db.acquire_invite_lock(user_id)
+    if not lock:
+        db.release_idempotent_request(idempotency_key)
+        await bot.send_message(chat_id=message.chat_id, text="⏳ 你有一个邀请码请求正在处理中，请稍候。")
+        return
+    
+    pending = {
+        'user_id': user_id,
+        'chat_id': message.chat_id,
+        'is_admin': is_admin,
+        'instance_id': instance_id,
+        'state': PENDING_ACCEPTED,
+        'attempts': 0,
+        'updated_at': time.time()
+    }
+    try:
+        # 幂等键同时作为签发记录的标识，重放完成后重复请求也能取回结果
+        await process_pending_invite(bot, idempotency_key, pending)
+    finally:
+        db.release_invite_lock(user_id, lock)
 
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """处理按钮回调"""
@@ -443,39 +934,345 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await query.edit_message_text(text=stats_text)
     # 处理管理员生成邀请码按钮
     elif query.data == "admin_invite" and db.is_admin(user_id):
+        # 多个实例时先选择实例
+        if len(MISSKEY_INSTANCES) > 1:
+            await query.edit_message_text(text="请选择要生成邀请码的实例：", reply_markup=build_instance_picker())
+            return
+        
         await query.edit_message_text(text="👑 管理员正在生成邀请码...")
         
         # 创建新的更新对象，因为回调查询不能直接用于发送新消息
         new_update = Update(update.update_id, message=query.message)
-        await generate_invite_code(new_update, user_id, is_admin=True)
+        # 同一菜单消息上的重复点击使用相同的幂等键，只会生成一个邀请码
+        await generate_invite_code(
+            new_update, user_id, is_admin=True,
+            idempotency_key=f"cb:{query.message.chat_id}:{query.message.message_id}:{query.data}",
+            instance_id=PRIMARY_INSTANCE_ID
+        )
+    # 处理实例选择按钮
+    elif query.data.startswith("pick_instance:"):
+        instance_id = query.data.split(":", 1)[1]
+        if instance_id not in MISSKEY_INSTANCES:
+            await query.edit_message_text(text="⚠️ 该实例已不可用，请重新使用 /invite 命令。")
+            return
+        
+        await query.edit_message_text(text=f"已选择 {MISSKEY_INSTANCES[instance_id]['name']}")
+        new_update = Update(update.update_id, message=query.message)
+        await start_invite(
+            new_update, user_id, instance_id,
+            idempotency_key=f"cb:{query.message.chat_id}:{query.message.message_id}:{query.data}"
+        )
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """处理错误"""
     logger.error(f"更新 {update} 导致错误 {context.error}")
+    
+    # Redis 不可用且没有可用的缓存时，提示用户稍后再试
+    if isinstance(context.error, resilience.REDIS_ERRORS):
+        resilience.mark_unavailable(context.error)
+        if isinstance(update, Update) and update.effective_message:
+            await update.effective_message.reply_text("⚠️ 服务暂时不可用，请稍后再试。")
 
-def main() -> None:
-    """启动机器人"""
-    # 创建应用
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+async def health_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """处理 /health 命令 - 查看 Redis 连接和降级运行状态"""
+    user_id = update.effective_user.id
+    
+    # 检查是否为管理员
+    if not db.is_admin(user_id):
+        await update.message.reply_text("⚠️ 你不是管理员，无法使用此命令。")
+        return
     
+    health = resilience.HEALTH
+    if health['redis_available']:
+        status = "✅ 正常"
+    else:
+        status = f"⚠️ 降级运行中（已持续 {time.time() - health['degraded_since']:.0f} 秒）"
+    
+    health_text = (
+        "🩺 运行状态 🩺\n\n"
+        f"Redis: {status}\n"
+        f"待重放的写操作: {len(resilience.JOURNAL)}\n"
+        f"已重放的写操作: {health['replayed_writes']}\n"
+        f"因日志已满丢弃的写操作: {health['dropped_writes']}\n"
+        f"缓存的读取结果: {len(resilience.READ_CACHE)}（降级期间命中 {health['cache_hits']} 次）\n"
+        f"事件循环最大延迟: {profiler.LOOP_LAG['max_ms']:.0f} ms\n"
+    )
+    if health['last_error']:
+        health_text += f"最近的 Redis 错误: {health['last_error']}\n"
+    
+    await update.message.reply_text(health_text)
+
+# 后台任务
+async def stats_rollup_job() -> None:
+    """定期把每日统计折叠进周、月汇总，避免每日统计过期后丢失长期趋势"""
+    while True:
+        try:
+            folded = await asyncio.to_thread(db.rollup_stats)
+            if folded:
+                logger.info(f"已将 {folded} 天的统计折叠进周、月汇总")
+        except Exception as e:
+            logger.error(f"统计汇总时出错: {e}")
+        await asyncio.sleep(STATS_ROLLUP_INTERVAL_SECONDS)
+
+async def history_compaction_job() -> None:
+    """定期按保留策略把旧的邀请码历史移入归档"""
+    while True:
+        try:
+            archived = await asyncio.to_thread(db.compact_histories)
+            if archived:
+                logger.info(f"已归档 {archived} 条邀请码历史")
+        except Exception as e:
+            logger.error(f"归档邀请码历史时出错: {e}")
+        await asyncio.sleep(HISTORY_COMPACTION_INTERVAL_SECONDS)
+
+async def captcha_warm_up_job() -> None:
+    """在后台预热验证码生成器，首个 /invite 请求无需等待 PIL 和 captcha 导入"""
+    try:
+        await asyncio.to_thread(captcha.warm_up)
+        logger.info("验证码生成器预热完成")
+    except Exception as e:
+        logger.error(f"预热验证码生成器时出错: {e}")
+
+async def replay_pending_invites(bot) -> None:
+    """重放上次停机时未完成的邀请码签发"""
+    # 降级期间暂存的签发记录重放完之前，Redis 中的签发状态可能不是最新的
+    if resilience.is_degraded():
+        return
+    
+    pending_invites = await asyncio.to_thread(db.get_pending_invites)
+    
+    for token, pending in pending_invites.items():
+        # 仍可能由其他实例处理中的记录暂不重放
+        if time.time() - pending['updated_at'] < PENDING_REPLAY_DELAY_SECONDS:
+            continue
+        if not db.claim_pending_invite(token, PENDING_REPLAY_DELAY_SECONDS):
+            continue
+        
+        if pending['attempts'] >= PENDING_REPLAY_MAX_ATTEMPTS:
+            logger.error(f"邀请码签发 {token} 多次重放失败，已放弃: {pending}")
+            db.delete_pending_invite(token)
+            db.release_idempotent_request(token)
+            await bot.send_message(
+                chat_id=pending['chat_id'],
+                text="❌ 你之前的邀请码请求未能完成，请使用 /invite 命令重新获取。"
+            )
+            continue
+        
+        pending.update(attempts=pending['attempts'] + 1, updated_at=time.time())
+        db.save_pending_invite(token, pending)
+        logger.info(f"重放未完成的邀请码签发 {token}，状态 {pending['state']}")
+        
+        try:
+            await process_pending_invite(
+                bot, token, pending,
+                notice="ℹ️ 你之前的邀请码请求因服务重启中断，现已完成。\n\n"
+            )
+        except Exception as e:
+            logger.error(f"重放邀请码签发 {token} 时出错: {e}")
+        
+        # 逐条重放，避免重启后集中请求 Misskey
+        await asyncio.sleep(1)
+
+async def redis_recovery_job() -> None:
+    """降级期间定期检查 Redis 是否恢复，恢复后重放暂存的写操作"""
+    while True:
+        await asyncio.sleep(REDIS_RECOVERY_CHECK_SECONDS)
+        if not resilience.is_degraded():
+            continue
+        try:
+            await asyncio.to_thread(db.get_redis().ping)
+            resilience.mark_available()
+            replayed = await asyncio.to_thread(resilience.replay_journal)
+            if replayed:
+                logger.info(f"重放降级期间暂存的写操作 {replayed} 条，剩余 {len(resilience.JOURNAL)} 条")
+        except resilience.REDIS_ERRORS as e:
+            resilience.mark_unavailable(e)
+        except Exception as e:
+            logger.error(f"检查 Redis 状态时出错: {e}")
+
+async def admin_registry_job() -> None:
+    """订阅管理员变更通知并定期重新同步，角色变更无需重启即可在所有副本生效"""
+    pubsub = None
+    last_sync = 0
+    try:
+        while True:
+            try:
+                if pubsub is None:
+                    pubsub = db.get_redis().pubsub(ignore_subscribe_messages=True)
+                    await asyncio.to_thread(pubsub.subscribe, ADMINS_CHANNEL)
+                    # 重新订阅后立即同步，补上断开期间的变更
+                    last_sync = 0
+                
+                message = await asyncio.to_thread(pubsub.get_message, timeout=1.0)
+                if message or time.monotonic() - last_sync >= ADMIN_RESYNC_INTERVAL_SECONDS:
+                    await asyncio.to_thread(db.load_admins)
+                    last_sync = time.monotonic()
+            except Exception as e:
+                logger.error(f"同步管理员列表时出错: {e}")
+                if pubsub is not None:
+                    pubsub.close()
+                    pubsub = None
+                await asyncio.sleep(REDIS_RECOVERY_CHECK_SECONDS)
+    finally:
+        if pubsub is not None:
+            pubsub.close()
+
+async def event_consumer_job() -> None:
+    """消费事件流，异步更新统计和活动汇总"""
+    while True:
+        try:
+            await asyncio.to_thread(db.ensure_event_group)
+            while True:
+                await asyncio.to_thread(events.consume_once)
+        except Exception as e:
+            logger.error(f"处理事件流时出错: {e}")
+            await asyncio.sleep(REDIS_RECOVERY_CHECK_SECONDS)
+
+async def pending_invite_replay_job(application: Application) -> None:
+    """定期检查并重放中断的邀请码签发"""
+    while True:
+        try:
+            await replay_pending_invites(application.bot)
+        except Exception as e:
+            logger.error(f"重放未完成的邀请码签发时出错: {e}")
+        await asyncio.sleep(PENDING_REPLAY_DELAY_SECONDS)
+
+async def post_init(application: Application) -> None:
+    """应用初始化完成后启动后台任务"""
+    BACKGROUND_TASKS.append(asyncio.create_task(captcha_warm_up_job()))
+    BACKGROUND_TASKS.append(asyncio.create_task(stats_rollup_job()))
+    BACKGROUND_TASKS.append(asyncio.create_task(history_compaction_job()))
+    BACKGROUND_TASKS.append(asyncio.create_task(pending_invite_replay_job(application)))
+    BACKGROUND_TASKS.append(asyncio.create_task(profiler.monitor_loop_lag(LOOP_LAG_THRESHOLD_MS)))
+    BACKGROUND_TASKS.append(asyncio.create_task(redis_recovery_job()))
+    BACKGROUND_TASKS.append(asyncio.create_task(admin_registry_job()))
+    BACKGROUND_TASKS.append(asyncio.create_task(event_consumer_job()))
+
+async def post_shutdown(application: Application) -> None:
+    """应用关闭时取消后台任务"""
+    for task in BACKGROUND_TASKS:
+        task.cancel()
+    await asyncio.gather(*BACKGROUND_TASKS, return_exceptions=True)
+    BACKGROUND_TASKS.clear()
+    stats_export.shutdown_chart_executor()
+    
+    # 停机前尝试写回降级期间暂存的写操作
+    if resilience.JOURNAL:
+        await asyncio.to_thread(resilience.replay_journal)
+        if resilience.JOURNAL:
+            logger.error(f"停机时仍有 {len(resilience.JOURNAL)} 条写操作未能写入 Redis，已丢失")
+
+def setup_logging() -> None:
+    """配置 loguru 日志，日志文件在首次写入时才创建"""
+    logger.remove()
+    logger.add(sys.stderr, level="INFO")  # 控制台输出
+    logger.add("logs/info.log", rotation="1 week", retention="1 month", level="INFO", delay=True)  # 信息日志
+    logger.add("logs/error.log", rotation="1 week", retention="1 month", level="ERROR", delay=True)  # 错误日志
+    logger.add("logs/debug.log", rotation="1 week", retention="1 month", level="DEBUG", delay=True)  # 调试日志
+    logger.add("logs/all.log", rotation="1 week", retention="1 month", delay=True)  # 所有日志
+
+def register_handlers(application: Application) -> None:
+    """注册所有处理器"""
+    # 所有处理器都会被统计，停机时等待它们执行完成
     # 添加命令处理器
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CommandHandler("invite", invite_command))
-    application.add_handler(CommandHandler("history", history_command))
-    application.add_handler(CommandHandler("info", info_command))
-    application.add_handler(CommandHandler("admin", admin_command))
-    application.add_handler(CommandHandler("stats", stats_command))
+    application.add_handler(CommandHandler("start", lifecycle.tracked(start)))
+    application.add_handler(CommandHandler("help", lifecycle.tracked(help_command)))
+    application.add_handler(CommandHandler("invite", lifecycle.tracked(invite_command)))
+    application.add_handler(CommandHandler("history", lifecycle.tracked(history_command)))
+    application.add_handler(CommandHandler("info", lifecycle.tracked(info_command)))
+    application.add_handler(CommandHandler("admin", lifecycle.tracked(admin_command)))
+    application.add_handler(CommandHandler("stats", lifecycle.tracked(stats_command)))
+    application.add_handler(CommandHandler("chart", lifecycle.tracked(chart_command)))
+    application.add_handler(CommandHandler("export", lifecycle.tracked(export_command)))
+    application.add_handler(CommandHandler("profile", lifecycle.tracked(profile_command)))
+    application.add_handler(CommandHandler("health", lifecycle.tracked(health_command)))
+    application.add_handler(CommandHandler("admins", lifecycle.tracked(admins_command)))
+    application.add_handler(CommandHandler("addadmin", lifecycle.tracked(addadmin_command)))
+    application.add_handler(CommandHandler("deladmin", lifecycle.tracked(deladmin_command)))
     
     # 添加消息处理器
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_captcha_response))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, lifecycle.tracked(handle_captcha_response)))
     
     # 添加回调查询处理器
-    application.add_handler(CallbackQueryHandler(button_callback))
+    application.add_handler(CallbackQueryHandler(lifecycle.tracked(button_callback)))
     
     # 添加错误处理器
     application.add_error_handler(error_handler)
+
+def create_application(token=None, redis_url=None, redis_client=None, configure_logging=True) -> Application:
+    """
+    应用工厂：显式装配依赖并创建机器人应用
+    
+    PIL 和 captcha 不在这里导入，而是在启动后由后台任务预热或在首次使用时导入。
+    
+    参数:
+        token (str): Telegram 机器人 Token，默认使用 TELEGRAM_BOT_TOKEN
+        redis_url (str): Redis 连接 URL，默认使用 REDIS_URL
+        redis_client: 已创建好的 Redis 客户端，传入时忽略 redis_url
+        configure_logging (bool): 是否配置日志输出
+    
+    返回:
+        Application: 已注册处理器的机器人应用
+    """
+    if configure_logging:
+        setup_logging()
+    
+    # 初始化 Redis 客户端
+    db.init_redis(redis_url or REDIS_URL, client=redis_client)
     
-    # 启动机器人
+    # 预先计算由配置推导出的 URL，处理请求时直接复用
+    for instance_id, instance in MISSKEY_INSTANCES.items():
+        if instance['api_url']:
+            misskey.get_instance_url(instance_id)
+            misskey.get_invite_create_url(instance_id)
+    
+    # 创建应用
+    application = Application.builder().token(token or TELEGRAM_BOT_TOKEN).build()
+    register_handlers(application)
+    return application
+
+async def run_application(application: Application) -> None:
+    """
+    运行机器人直到收到停止信号，然后优雅停机
+    
+    停机顺序：停止拉取更新 -> 在截止时间内等待已接收的更新和处理中的请求完成
+    -> 停止应用和后台任务。截止时间内未完成的邀请码签发已保存在 Redis 中，
+    下次启动时会被重放。
+    """
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    
+    await application.initialize()
+    await post_init(application)
+    await application.start()
+    await application.updater.start_polling()
     logger.info("启动机器人")
-    application.run_polling() 
\ No newline at end of file
+    
+    try:
+        await stop_event.wait()
+    finally:
+        logger.info("收到停止信号，停止接收新的更新")
+        await application.updater.stop()
+        
+        started = time.monotonic()
+        if await lifecycle.drain(application.update_queue, SHUTDOWN_DRAIN_TIMEOUT_SECONDS):
+            logger.info("处理中的请求已全部完成")
+        else:
+            logger.warning("等待处理中的请求超时，未完成的邀请码签发将在下次启动时重放")
+        
+        remaining = max(SHUTDOWN_DRAIN_TIMEOUT_SECONDS - (time.monotonic() - started), 1)
+        try:
+            await asyncio.wait_for(application.stop(), timeout=remaining)
+        except asyncio.TimeoutError:
+            logger.warning("停止应用超时")
+        
+        await post_shutdown(application)
+        await application.shutdown()
+        logger.info("机器人已停止")
+
+def main() -> None:
+    """启动机器人"""
+    application = create_application()
+    asyncio.run(run_application(application))
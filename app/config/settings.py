@@ -3,6 +3,7 @@
 """
 import os
 import json
+import re
 from dotenv import load_dotenv
 
 # 加载环境变量
@@ -15,32 +16,196 @@ TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 MISSKEY_API_URL = os.getenv('MISSKEY_API_URL')
 MISSKEY_API_TOKEN = os.getenv('MISSKEY_API_TOKEN')
 INVITE_CODE_EXPIRY_DAYS = int(os.getenv('INVITE_CODE_EXPIRY_DAYS', 7))
+MISSKEY_API_TIMEOUT = int(os.getenv('MISSKEY_API_TIMEOUT', 10))
+# 每个实例的 HTTP 连接池大小
+MISSKEY_POOL_SIZE = int(os.getenv('MISSKEY_POOL_SIZE', 10))
 
 # Redis 配置
 REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
 
+# Redis 连接模式：standalone（单节点）、sentinel（哨兵）或 cluster（集群）
+REDIS_MODE = os.getenv('REDIS_MODE', 'standalone').lower()
+# 哨兵地址，格式为逗号分隔的 host:port
+REDIS_SENTINELS = os.getenv('REDIS_SENTINELS', '')
+REDIS_SENTINEL_MASTER = os.getenv('REDIS_SENTINEL_MASTER', 'mymaster')
+REDIS_SENTINEL_PASSWORD = os.getenv('REDIS_SENTINEL_PASSWORD')
+REDIS_PASSWORD = os.getenv('REDIS_PASSWORD')
+REDIS_DB = int(os.getenv('REDIS_DB', 0))
+# 只读查询（历史、用户信息、统计）是否发往副本
+REDIS_READ_FROM_REPLICAS = os.getenv('REDIS_READ_FROM_REPLICAS', 'false').lower() == 'true'
+# 单节点模式下的只读副本地址
+REDIS_REPLICA_URL = os.getenv('REDIS_REPLICA_URL')
+# 是否在键中使用哈希标签，使同一用户的键、所有统计键分别落在同一槽位；集群模式下默认开启
+REDIS_HASH_TAGS = os.getenv('REDIS_HASH_TAGS', str(REDIS_MODE == 'cluster')).lower() == 'true'
+# 建立连接和等待响应的超时时间（秒）；网络丢包时请求在超时后失败并进入降级模式，而不是等待系统 TCP 超时。
+# 读超时需大于事件消费者阻塞读取的 1 秒
+REDIS_CONNECT_TIMEOUT = float(os.getenv('REDIS_CONNECT_TIMEOUT', 2))
+REDIS_SOCKET_TIMEOUT = float(os.getenv('REDIS_SOCKET_TIMEOUT', 2))
+
 # 应用配置
 MAX_INVITES_PER_WEEK = int(os.getenv('MAX_INVITES_PER_WEEK', 1))
 CAPTCHA_EXPIRY_SECONDS = int(os.getenv('CAPTCHA_EXPIRY_SECONDS', 300))
 
+# 验证码限流配置
+# 同一用户两次获取验证码之间的最短间隔（秒）
+CAPTCHA_COOLDOWN_SECONDS = int(os.getenv('CAPTCHA_COOLDOWN_SECONDS', 30))
+# 全局验证码生成速率（每秒）和突发上限
+CAPTCHA_ISSUE_RATE = float(os.getenv('CAPTCHA_ISSUE_RATE', 5))
+CAPTCHA_ISSUE_BURST = int(os.getenv('CAPTCHA_ISSUE_BURST', 20))
+# 全局验证码校验速率（每秒）和突发上限
+CAPTCHA_VERIFY_RATE = float(os.getenv('CAPTCHA_VERIFY_RATE', 20))
+CAPTCHA_VERIFY_BURST = int(os.getenv('CAPTCHA_VERIFY_BURST', 50))
+# 在统计窗口（秒）内验证失败达到次数上限后临时封禁（秒）
+CAPTCHA_MAX_FAILURES = int(os.getenv('CAPTCHA_MAX_FAILURES', 5))
+CAPTCHA_FAILURE_WINDOW_SECONDS = int(os.getenv('CAPTCHA_FAILURE_WINDOW_SECONDS', 3600))
+CAPTCHA_BAN_SECONDS = int(os.getenv('CAPTCHA_BAN_SECONDS', 3600))
+
 # Redis 键前缀
 USER_PREFIX = 'user:'
 CAPTCHA_PREFIX = 'captcha:'
 INVITE_CODE_PREFIX = 'invite_code:'
+INVITE_ARCHIVE_PREFIX = 'invite_archive:'
 STATS_PREFIX = 'stats:'
+STATS_WEEKLY_PREFIX = 'stats:week:'
+STATS_MONTHLY_PREFIX = 'stats:month:'
+STATS_ROLLUP_MARK_PREFIX = 'stats:rolled:'
+STATS_ACTIVITY_PREFIX = 'stats:activity:'
+# 统计版本号，每次统计更新时递增，用于图表缓存失效
+STATS_VERSION_KEY = 'stats:version'
+# 旧版本记录统计最后更新日期的键，迁移键布局时跳过
+STATS_LAST_UPDATED_KEY = 'stats:last_updated'
+CHART_CACHE_PREFIX = 'chart:'
+PENDING_INVITES_KEY = 'pending_invites'
+PENDING_LOCK_PREFIX = 'pending_lock:'
+IDEMPOTENCY_PREFIX = 'idem:'
+INVITE_LOCK_PREFIX = 'invite_lock:'
+THROTTLE_PREFIX = 'throttle:'
+EVENTS_STREAM_KEY = 'events'
+EVENT_PROCESSED_PREFIX = 'event_done:'
 
 # 管理员配置
-# 从环境变量中获取管理员ID列表，格式为逗号分隔的数字
-ADMIN_IDS = []
+# 从环境变量中获取管理员ID集合，格式为逗号分隔的数字；
+# 这些管理员始终有效，通过 /addadmin 添加的管理员保存在 Redis 集合 ADMINS_KEY 中
+ADMIN_IDS = frozenset()
 admin_ids_str = os.getenv('ADMIN_IDS', '')
 if admin_ids_str:
     try:
-        ADMIN_IDS = [int(admin_id.strip()) for admin_id in admin_ids_str.split(',') if admin_id.strip()]
+        ADMIN_IDS = frozenset(int(admin_id.strip()) for admin_id in admin_ids_str.split(',') if admin_id.strip())
     except ValueError:
         print("警告: ADMIN_IDS 格式不正确，应为逗号分隔的数字")
+ADMINS_KEY = 'admins'
+# 管理员变更通知频道，所有副本收到后立即重新加载
+ADMINS_CHANNEL = 'admins:changed'
+# 定期从 Redis 重新同步管理员集合的间隔（秒），用于补上错过的通知
+ADMIN_RESYNC_INTERVAL_SECONDS = int(os.getenv('ADMIN_RESYNC_INTERVAL_SECONDS', 60))
 
 # 统计数据保留天数
 STATS_RETENTION_DAYS = int(os.getenv('STATS_RETENTION_DAYS', 30))
 
+# 统计汇总间隔（秒），每日统计在过期前折叠进周、月汇总
+STATS_ROLLUP_INTERVAL_SECONDS = int(os.getenv('STATS_ROLLUP_INTERVAL_SECONDS', 3600))
+# 每日统计在结束多少天后才折叠，留出时间给迟到的写入；尚未折叠的日期在读取汇总时合并
+STATS_ROLLUP_DELAY_DAYS = int(os.getenv('STATS_ROLLUP_DELAY_DAYS', 2))
+
+# 统计图表缓存时间（秒）
+CHART_CACHE_TTL_SECONDS = int(os.getenv('CHART_CACHE_TTL_SECONDS', 86400))
+
+# 单次导出的最大天数
+EXPORT_MAX_DAYS = int(os.getenv('EXPORT_MAX_DAYS', 3660))
+
+# 邀请码历史保留策略：最近 HISTORY_HOT_DAYS 天内或仍然有效的记录保留在热数据中，
+# 其余记录按月压缩归档；热数据超过 HISTORY_HOT_MAX_RECORDS 条时，最旧的记录也会被归档。
+# HISTORY_HOT_DAYS 不应小于 7，否则每周配额检查会看不到已归档的记录
+HISTORY_HOT_DAYS = max(int(os.getenv('HISTORY_HOT_DAYS', 90)), 7)
+HISTORY_HOT_MAX_RECORDS = int(os.getenv('HISTORY_HOT_MAX_RECORDS', 50))
+HISTORY_COMPACTION_INTERVAL_SECONDS = int(os.getenv('HISTORY_COMPACTION_INTERVAL_SECONDS', 86400))
+
+# 邀请码签发幂等记录的保留时间（秒），重复的更新或按钮点击在此期间直接返回首次结果
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv('IDEMPOTENCY_TTL_SECONDS', 86400))
+# 每个用户同一时间只能有一个签发在处理中，锁的最长持有时间（秒）
+INVITE_LOCK_SECONDS = int(os.getenv('INVITE_LOCK_SECONDS', 60))
+
+# 事件循环阻塞超过该时间（毫秒）时记录日志
+LOOP_LAG_THRESHOLD_MS = int(os.getenv('LOOP_LAG_THRESHOLD_MS', 200))
+# /profile 命令的最长采样时间（秒）和采样间隔（毫秒）
+PROFILE_MAX_SECONDS = int(os.getenv('PROFILE_MAX_SECONDS', 60))
+PROFILE_SAMPLE_INTERVAL_MS = int(os.getenv('PROFILE_SAMPLE_INTERVAL_MS', 10))
+
+# Redis 不可用时的降级运行配置
+# 暂存在内存中、等待 Redis 恢复后重放的写操作上限
+DEGRADED_JOURNAL_MAX_ENTRIES = int(os.getenv('DEGRADED_JOURNAL_MAX_ENTRIES', 1000))
+# 缓存的最近读取结果数量，以及降级期间可以使用的缓存时长（秒）
+DEGRADED_CACHE_MAX_ENTRIES = int(os.getenv('DEGRADED_CACHE_MAX_ENTRIES', 2000))
+DEGRADED_CACHE_TTL_SECONDS = int(os.getenv('DEGRADED_CACHE_TTL_SECONDS', 600))
+# 降级期间检查 Redis 是否恢复的间隔（秒）
+REDIS_RECOVERY_CHECK_SECONDS = int(os.getenv('REDIS_RECOVERY_CHECK_SECONDS', 5))
+
+# 事件流配置
+# 消费统计事件的消费者组名称，多个副本共用一个组，每个事件只由一个副本处理
+EVENTS_CONSUMER_GROUP = os.getenv('EVENTS_CONSUMER_GROUP', 'stats')
+# 事件流保留的大致条数，超出后裁剪最旧的事件
+EVENTS_STREAM_MAXLEN = int(os.getenv('EVENTS_STREAM_MAXLEN', 100000))
+# 每次读取的事件数
+EVENTS_BATCH_SIZE = int(os.getenv('EVENTS_BATCH_SIZE', 100))
+# 已投递但超过该时间（秒）未确认的事件会被其他消费者接管重新处理
+EVENTS_CLAIM_IDLE_SECONDS = int(os.getenv('EVENTS_CLAIM_IDLE_SECONDS', 60))
+# 已处理事件标记的保留时间（秒），在此期间重复投递的事件不会被重复计入
+EVENT_DEDUPE_TTL_SECONDS = int(os.getenv('EVENT_DEDUPE_TTL_SECONDS', 7 * 24 * 60 * 60))
+
+# 停机时等待处理中请求完成的最长时间（秒），应小于容器的停止宽限期
+SHUTDOWN_DRAIN_TIMEOUT_SECONDS = int(os.getenv('SHUTDOWN_DRAIN_TIMEOUT_SECONDS', 20))
+
+# 未完成的邀请码签发超过该时间（秒）未更新时，视为中断并重放
+PENDING_REPLAY_DELAY_SECONDS = int(os.getenv('PENDING_REPLAY_DELAY_SECONDS', 60))
+PENDING_REPLAY_MAX_ATTEMPTS = int(os.getenv('PENDING_REPLAY_MAX_ATTEMPTS', 3))
+
 # 实例名称配置
-INSTANCE_NAME = os.getenv('INSTANCE_NAME', 'Misskey')
\ No newline at end of file
+INSTANCE_NAME = os.getenv('INSTANCE_NAME', 'Misskey')
+
+# 多实例配置
+# MISSKEY_INSTANCES 为 JSON 数组或 JSON 文件路径，每项包含 id、name、api_url、api_token，
+# 可选 invite_expiry_days、max_invites_per_week；未设置时使用上面的单实例配置，实例 ID 为 default。
+# ID 为 default 的实例沿用原有的 Redis 键，其他实例的键带有实例 ID 前缀
+DEFAULT_INSTANCE_ID = 'default'
+
+def _load_misskey_instances():
+    """解析实例配置，返回 实例 ID -> 实例配置 的有序字典"""
+    raw = os.getenv('MISSKEY_INSTANCES', '').strip()
+    if not raw:
+        entries = [{
+            'id': DEFAULT_INSTANCE_ID,
+            'name': INSTANCE_NAME,
+            'api_url': MISSKEY_API_URL,
+            'api_token': MISSKEY_API_TOKEN
+        }]
+    else:
+        if not raw.startswith('['):
+            with open(raw, encoding='utf-8') as f:
+                raw = f.read()
+        entries = json.loads(raw)
+    
+    instances = {}
+    for entry in entries:
+        instance_id = str(entry['id'])
+        # 实例 ID 会出现在 Redis 键和回调数据中，以字母开头以便与用户 ID 区分
+        if not re.fullmatch(r'[A-Za-z][A-Za-z0-9_-]{0,31}', instance_id):
+            raise ValueError(f"实例 ID 格式不正确: {instance_id}")
+        instances[instance_id] = {
+            'id': instance_id,
+            'name': entry.get('name') or instance_id,
+            'api_url': entry.get('api_url'),
+            'api_token': entry.get('api_token'),
+            'invite_expiry_days': int(entry.get('invite_expiry_days', INVITE_CODE_EXPIRY_DAYS)),
+            'max_invites_per_week': int(entry.get('max_invites_per_week', MAX_INVITES_PER_WEEK))
+        }
+    if not instances:
+        raise ValueError("MISSKEY_INSTANCES 至少需要包含一个实例")
+    return instances
+
+MISSKEY_INSTANCES = _load_misskey_instances()
+
+# 只有一个实例时使用的实例，以及没有实例 ID 的旧记录所属的实例：
+# 配置中有 ID 为 default 的实例时为该实例，否则为配置中的第一个实例
+PRIMARY_INSTANCE_ID = (
+    DEFAULT_INSTANCE_ID if DEFAULT_INSTANCE_ID in MISSKEY_INSTANCES else next(iter(MISSKEY_INSTANCES))
+)
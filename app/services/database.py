@@ -1,54 +1,214 @@
 """
 数据库服务
 """
-import json
 import time
+import uuid
+import zlib
 from datetime import datetime, timedelta
+
 import redis
 
 from app.config.settings import (
-    REDIS_URL, USER_PREFIX, CAPTCHA_PREFIX, INVITE_CODE_PREFIX, STATS_PREFIX,
-    CAPTCHA_EXPIRY_SECONDS, MAX_INVITES_PER_WEEK, ADMIN_IDS, STATS_RETENTION_DAYS
+    REDIS_URL, REDIS_HASH_TAGS, USER_PREFIX, CAPTCHA_PREFIX, INVITE_CODE_PREFIX, STATS_PREFIX,
+    INVITE_ARCHIVE_PREFIX, HISTORY_HOT_DAYS, HISTORY_HOT_MAX_RECORDS,
+    STATS_WEEKLY_PREFIX, STATS_MONTHLY_PREFIX, STATS_ROLLUP_MARK_PREFIX, STATS_ACTIVITY_PREFIX,
+    STATS_ROLLUP_DELAY_DAYS,
+    EVENTS_STREAM_KEY, EVENTS_STREAM_MAXLEN, EVENTS_CONSUMER_GROUP, EVENT_PROCESSED_PREFIX,
+    EVENT_DEDUPE_TTL_SECONDS,
+    STATS_VERSION_KEY, STATS_LAST_UPDATED_KEY, CHART_CACHE_PREFIX, PENDING_INVITES_KEY, PENDING_LOCK_PREFIX,
+    IDEMPOTENCY_PREFIX, INVITE_LOCK_PREFIX, IDEMPOTENCY_TTL_SECONDS, INVITE_LOCK_SECONDS,
+    CAPTCHA_EXPIRY_SECONDS, ADMIN_IDS, ADMINS_KEY, ADMINS_CHANNEL, STATS_RETENTION_DAYS, MISSKEY_INSTANCES, DEFAULT_INSTANCE_ID,
+    PRIMARY_INSTANCE_ID
 )
+from app.services import resilience, serialization
+from app.services.redis_connection import create_redis_clients
+
+# Redis 客户端，由 init_redis 创建，未初始化时在首次使用时按配置创建
+# redis_client 连接主节点，reader_client 用于可以容忍复制延迟的只读查询
+redis_client = None
+reader_client = None
+
+# 管理员集合：配置中的 ADMIN_IDS 与 Redis 集合的并集，由 load_admins 整体替换，
+# 检查管理员时只做一次集合查找，不访问 Redis
+ADMINS = ADMIN_IDS
+
+# 所有统计键共用的哈希标签，使折叠脚本和批量读取可以在集群中执行
+STATS_HASH_TAG = '{stats}'
+
+def init_redis(url=None, client=None, reader=None):
+    """
+    初始化 Redis 客户端
+
+    参数:
+        url (str): Redis 连接 URL，默认使用 REDIS_URL
+        client: 已创建好的主节点客户端，传入时直接使用
+        reader: 已创建好的只读客户端，默认与主节点客户端相同
+    """
+    global redis_client, reader_client
+    if client is not None:
+        redis_client, reader_client = client, reader if reader is not None else client
+    else:
+        redis_client, reader_client = create_redis_clients(url or REDIS_URL)
+    return redis_client
+
+def get_redis():
+    """获取主节点 Redis 客户端"""
+    if redis_client is None:
+        init_redis()
+    return redis_client
+
+def get_redis_reader():
+    """获取只读查询使用的 Redis 客户端，开启副本读取时连接副本"""
+    if reader_client is None:
+        init_redis()
+    return reader_client
+
+# 键名
+def _tag(value):
+    """开启哈希标签时把值包在 {} 中，使同一用户的键落在同一槽位"""
+    return f"{{{value}}}" if REDIS_HASH_TAGS else str(value)
+
+def user_key(user_id):
+    return f"{USER_PREFIX}{_tag(user_id)}"
+
+def captcha_key(user_id):
+    return f"{CAPTCHA_PREFIX}{_tag(user_id)}"
+
+def _instance_prefix(instance_id):
+    """默认实例沿用原有的键，其他实例的键带有实例 ID 前缀"""
+    return '' if instance_id == DEFAULT_INSTANCE_ID else f"{instance_id}:"
+
+def _parse_user_key(rest):
+    """
+    解析去掉类型前缀后的用户键
+
+    返回:
+        tuple: (实例 ID, 用户 ID 字符串, 后缀)，如 'inst:{42}:2024-01' -> ('inst', '42', '2024-01')
+    """
+    parts = rest.split(':')
+    instance_id = DEFAULT_INSTANCE_ID
+    # 实例 ID 以字母开头，用户 ID 为数字
+    if len(parts) > 1 and not parts[0].strip('{}').isdigit():
+        instance_id = parts.pop(0)
+    return instance_id, parts[0].strip('{}'), ':'.join(parts[1:])
+
+def history_key(user_id, instance_id=PRIMARY_INSTANCE_ID):
+    return f"{INVITE_CODE_PREFIX}{_instance_prefix(instance_id)}{_tag(user_id)}"
+
+def invite_lock_key(user_id):
+    return f"{INVITE_LOCK_PREFIX}{_tag(user_id)}"
+
+def archive_index_key(user_id, instance_id=PRIMARY_INSTANCE_ID):
+    """归档索引：月份 -> 该月归档的记录数"""
+    return f"{INVITE_ARCHIVE_PREFIX}{_instance_prefix(instance_id)}{_tag(user_id)}"
+
+def archive_key(user_id, month, instance_id=PRIMARY_INSTANCE_ID):
+    """某个月份的压缩归档"""
+    return f"{INVITE_ARCHIVE_PREFIX}{_instance_prefix(instance_id)}{_tag(user_id)}:{month}"
 
-# 连接到Redis
-redis_client = redis.from_url(REDIS_URL)
+def stats_key(prefix, label):
+    """统计键，开启哈希标签时所有统计键共用一个槽位"""
+    if REDIS_HASH_TAGS:
+        return f"{prefix}{STATS_HASH_TAG}{label}"
+    return f"{prefix}{label}"
 
 # 用户相关操作
+@resilience.write_behind
 def save_user(user_id, username, first_name, last_name=None):
     """保存用户信息到Redis"""
     user_data = {
         'username': username,
         'first_name': first_name,
         'last_name': last_name,
-        'registered_at': datetime.now().isoformat(),
-        'is_admin': user_id in ADMIN_IDS
+        'registered_at': int(time.time()),
+        'is_admin': is_admin(user_id)
     }
-    redis_client.set(f"{USER_PREFIX}{user_id}", json.dumps(user_data))
+    get_redis().set(user_key(user_id), serialization.encode(user_data))
 
+@resilience.cached_read
 def get_user(user_id):
     """从Redis获取用户信息"""
-    user_data = redis_client.get(f"{USER_PREFIX}{user_id}")
+    user_data = get_redis_reader().get(user_key(user_id))
     if user_data:
-        return json.loads(user_data)
+        return serialization.decode(user_data)
     return None
 
+@resilience.cached_read
+def get_user_profile(user_id, instance_ids=None):
+    """
+    一次往返读取用户信息、邀请码历史和归档索引
+
+    这些键带有相同的哈希标签，在集群中也位于同一节点。
+
+    参数:
+        instance_ids (list): 要合并的实例，默认为所有实例
+
+    返回:
+        tuple: (用户信息或 None, 合并后的邀请码历史列表, 合并后的归档索引)，
+        历史中的每条记录带有所属的 instance_id
+    """
+    instance_ids = instance_ids or list(MISSKEY_INSTANCES)
+    pipe = get_redis_reader().pipeline(transaction=False)
+    pipe.get(user_key(user_id))
+    for instance_id in instance_ids:
+        pipe.get(history_key(user_id, instance_id))
+        pipe.hgetall(archive_index_key(user_id, instance_id))
+    user_data, *results = pipe.execute()
+    
+    history, archive_index = [], {}
+    for instance_id, raw_history, raw_index in zip(instance_ids, results[::2], results[1::2]):
+        if raw_history:
+            history.extend({**record, 'instance_id': instance_id}
+                           for record in serialization.decode(raw_history))
+        for month, count in _decode_archive_index(raw_index).items():
+            archive_index[month] = archive_index.get(month, 0) + count
+    history.sort(key=lambda record: record['requested_at'])
+    return (serialization.decode(user_data) if user_data else None, history, archive_index)
+
+# 管理员相关操作
 def is_admin(user_id):
     """检查用户是否为管理员"""
-    # 首先检查配置中的管理员列表
-    if user_id in ADMIN_IDS:
-        return True
-    
-    # 然后检查数据库中的用户信息
-    user = get_user(user_id)
-    return user and user.get('is_admin', False)
+    return user_id in ADMINS
+
+def load_admins():
+    """
+    从 Redis 重新加载管理员集合
+
+    返回:
+        frozenset: 当前的管理员 ID 集合
+    """
+    global ADMINS
+    members = get_redis().smembers(ADMINS_KEY)
+    ADMINS = ADMIN_IDS | {int(member) for member in members}
+    return ADMINS
+
+def get_admins():
+    """
+    获取管理员列表
+
+    返回:
+        list: [(用户 ID, 是否来自配置)]，按用户 ID 排序
+    """
+    return [(user_id, user_id in ADMIN_IDS) for user_id in sorted(ADMINS)]
+
+def add_admin(user_id):
+    """添加管理员，并通知所有副本重新加载"""
+    get_redis().sadd(ADMINS_KEY, user_id)
+    get_redis().publish(ADMINS_CHANNEL, f"add:{user_id}")
+    return load_admins()
+
+def remove_admin(user_id):
+    """移除通过命令添加的管理员，配置中的管理员不受影响"""
+    get_redis().srem(ADMINS_KEY, user_id)
+    get_redis().publish(ADMINS_CHANNEL, f"remove:{user_id}")
+    return load_admins()
 
 # 验证码相关操作
 def save_captcha(user_id, captcha_text, expiry_seconds=None):
     """保存验证码到Redis，默认5分钟过期"""
     if expiry_seconds is None:
         expiry_seconds = CAPTCHA_EXPIRY_SECONDS
-    redis_client.setex(f"{CAPTCHA_PREFIX}{user_id}", expiry_seconds, captcha_text)
+    get_redis().setex(captcha_key(user_id), expiry_seconds, captcha_text)
 
 def verify_captcha(user_id, captcha_text):
     """验证用户输入的验证码"""
@@ -56,133 +216,506 @@ def verify_captcha(user_id, captcha_text):
     if is_admin(user_id):
         return True
         
-    stored_captcha = redis_client.get(f"{CAPTCHA_PREFIX}{user_id}")
+    stored_captcha = get_redis().get(captcha_key(user_id))
     if stored_captcha and stored_captcha.decode('utf-8').lower() == captcha_text.lower():
-        redis_client.delete(f"{CAPTCHA_PREFIX}{user_id}")
+        get_redis().delete(captcha_key(user_id))
         return True
     return False
 
 # 邀请码相关操作
-def record_invite_code_request(user_id, invite_code, expiry_days=None):
-    """记录用户获取邀请码的信息"""
-    now = datetime.now()
+@resilience.write_behind
+def record_invite_code_request(user_id, invite_code, expiry_days=None, instance_id=PRIMARY_INSTANCE_ID,
+                               requested_at=None):
+    """
+    记录用户获取邀请码的信息
+
+    只写入配额检查需要的邀请码历史，统计由事件流的消费者异步更新。
+    requested_at 为获取时间戳，默认为当前时间；降级期间暂存的记录重放时据此保留原始时间。
+    历史中已有该邀请码时不再写入，写入历史后追加事件失败、整个调用被重放时不会重复记录；
+    重放时追加的事件由统计按邀请码去重。
+    """
+    now = datetime.fromtimestamp(requested_at) if requested_at else datetime.now()
+    admin = is_admin(user_id)
     
     # 管理员生成的邀请码可以设置为永久有效
-    if is_admin(user_id) and expiry_days is None:
+    if admin and expiry_days is None:
         expiry_date = None
         expires_at = None
     else:
         expiry_date = now + timedelta(days=expiry_days)
-        expires_at = expiry_date.isoformat()
+        expires_at = int(expiry_date.timestamp())
     
     record = {
         'invite_code': invite_code,
-        'requested_at': now.isoformat(),
+        'requested_at': int(now.timestamp()),
         'expires_at': expires_at,
-        'is_admin_generated': is_admin(user_id)
+        'is_admin_generated': admin
     }
     
-    # 获取用户的邀请码历史记录
-    history_key = f"{INVITE_CODE_PREFIX}{user_id}"
-    history = redis_client.get(history_key)
+    def append_record(history_list):
+        if any(item['invite_code'] == invite_code for item in history_list):
+            return None
+        return history_list + [record]
     
-    if history:
-        history_list = json.loads(history)
-        history_list.append(record)
-    else:
-        history_list = [record]
+    # 保存更新后的历史记录，超出保留策略的记录移入归档
+    update_history(user_id, instance_id, append_record)
     
-    # 保存更新后的历史记录
-    redis_client.set(history_key, json.dumps(history_list))
-    
-    # 更新统计信息
-    update_invite_stats(invite_code, user_id, is_admin(user_id))
+    # 统计由事件消费者更新
+    append_event('invite', {
+        'user_id': user_id,
+        'invite_code': invite_code,
+        'is_admin': admin,
+        'instance_id': instance_id,
+        'ts': record['requested_at']
+    })
     
     return record
 
-def can_request_invite_code(user_id):
-    """检查用户是否可以请求邀请码（每周限制）"""
+def can_request_invite_code(user_id, instance_id=PRIMARY_INSTANCE_ID):
+    """检查用户是否可以请求邀请码（每个实例单独计算每周限制）"""
     # 管理员不受限制
     if is_admin(user_id):
         return True
         
-    history_key = f"{INVITE_CODE_PREFIX}{user_id}"
-    history = redis_client.get(history_key)
+    # 配额检查必须读主节点，避免复制延迟导致超额
+    history = get_redis().get(history_key(user_id, instance_id))
     
     if not history:
         return True
     
-    history_list = json.loads(history)
+    history_list = serialization.decode(history)
     
     # 计算一周前的时间
-    one_week_ago = (datetime.now() - timedelta(days=7)).isoformat()
+    one_week_ago = time.time() - 7 * 24 * 60 * 60
     
     # 统计一周内请求的邀请码数量
     recent_requests = sum(1 for record in history_list 
                          if record['requested_at'] > one_week_ago)
     
-    return recent_requests < MAX_INVITES_PER_WEEK
+    return recent_requests < MISSKEY_INSTANCES[instance_id]['max_invites_per_week']
 
-def get_user_invite_history(user_id):
+@resilience.cached_read
+def get_user_invite_history(user_id, instance_id=PRIMARY_INSTANCE_ID):
     """获取用户的邀请码历史记录"""
-    history_key = f"{INVITE_CODE_PREFIX}{user_id}"
-    history = redis_client.get(history_key)
+    history = get_redis_reader().get(history_key(user_id, instance_id))
     
     if history:
-        return json.loads(history)
+        return serialization.decode(history)
     return []
 
-# 统计相关操作
-def update_invite_stats(invite_code, user_id, is_admin):
-    """更新邀请码统计信息"""
-    today = datetime.now().strftime('%Y-%m-%d')
-    stats_key = f"{STATS_PREFIX}{today}"
-    
-    # 获取今日统计
-    stats = redis_client.get(stats_key)
-    if stats:
-        stats_data = json.loads(stats)
-    else:
-        stats_data = {
-            'total_invites': 0,
-            'admin_invites': 0,
-            'user_invites': 0,
-            'users': {}
-        }
-    
-    # 更新统计数据
-    stats_data['total_invites'] += 1
-    if is_admin:
-        stats_data['admin_invites'] += 1
-    else:
-        stats_data['user_invites'] += 1
+# 邀请码历史归档相关操作
+def split_history(history_list, now=None):
+    """
+    按保留策略把历史记录拆分为热数据和待归档数据
+
+    最近 HISTORY_HOT_DAYS 天内或仍然有效的记录保留为热数据；
+    热数据仍超过 HISTORY_HOT_MAX_RECORDS 条时，最旧的记录也会被归档。
+
+    返回:
+        tuple: (热数据列表, 待归档列表)，均按获取时间正序
+    """
+    now = now or time.time()
+    hot_since = now - HISTORY_HOT_DAYS * 24 * 60 * 60
     
-    # 记录用户信息
-    user_id_str = str(user_id)
-    if user_id_str in stats_data['users']:
-        stats_data['users'][user_id_str] += 1
-    else:
-        stats_data['users'][user_id_str] = 1
+    hot, cold = [], []
+    for record in history_list:
+        expires_at = record.get('expires_at')
+        still_valid = expires_at is None or expires_at > now
+        if record['requested_at'] >= hot_since or still_valid:
+            hot.append(record)
+        else:
+            cold.append(record)
     
-    # 保存统计数据
-    redis_client.set(stats_key, json.dumps(stats_data))
+    if len(hot) > HISTORY_HOT_MAX_RECORDS:
+        overflow = len(hot) - HISTORY_HOT_MAX_RECORDS
+        cold.extend(hot[:overflow])
+        hot = hot[overflow:]
     
-    # 设置过期时间（保留30天）
-    redis_client.expire(stats_key, STATS_RETENTION_DAYS * 24 * 60 * 60)
+    return hot, cold
+
+def _month_of(timestamp):
+    return datetime.fromtimestamp(timestamp).strftime('%Y-%m')
+
+def _decode_archive_index(archive_index):
+    return {month.decode('utf-8'): int(count) for month, count in archive_index.items()}
+
+def _decode_archive(blob):
+    return serialization.decode(zlib.decompress(blob)) if blob else []
+
+# 比较并写入历史和归档：读取后历史和各月归档都没有变化时才写入，否则返回 0 由调用方重试。
+# KEYS: 历史、归档索引、各月归档；ARGV: 读取时的历史、新的历史，之后每个月依次为
+# 读取时的归档、新的归档、月份、记录数（不存在的键以空字符串表示）
+HISTORY_CAS_SCRIPT = """
+if (redis.call('GET', KEYS[1]) or '') ~= ARGV[1] then
+    return 0
+end
+for i = 3, #KEYS do
+    if (redis.call('GET', KEYS[i]) or '') ~= ARGV[i * 4 - 9] then
+        return 0
+    end
+end
+for i = 3, #KEYS do
+    redis.call('SET', KEYS[i], ARGV[i * 4 - 8])
+    redis.call('HSET', KEYS[2], ARGV[i * 4 - 7], ARGV[i * 4 - 6])
+end
+redis.call('SET', KEYS[1], ARGV[2])
+return 1
+"""
+
+def archive_history(user_id, history, hot, cold, instance_id=PRIMARY_INSTANCE_ID):
+    """
+    把记录移入按月压缩的归档，并用剩余的热数据覆盖历史记录
+
+    history 为计算 hot、cold 时读取的原始历史；历史或归档在读取后被其他写入修改时不写入。
+    同一用户的历史、归档索引和归档键带有相同的哈希标签，在一个 Lua 脚本中比较并写入，
+    集群模式下同样可用。
+
+    返回:
+        bool: 是否写入
+    """
+    by_month = {}
+    for record in cold:
+        by_month.setdefault(_month_of(record['requested_at']), []).append(record)
+    months = sorted(by_month)
+    
+    # 读取已有的月度归档并合并
+    pipe = get_redis().pipeline(transaction=False)
+    for month in months:
+        pipe.get(archive_key(user_id, month, instance_id))
+    existing = pipe.execute() if months else []
+    
+    keys = [history_key(user_id, instance_id), archive_index_key(user_id, instance_id)]
+    args = [history or b'', serialization.encode(hot)]
+    for month, blob in zip(months, existing):
+        records = _decode_archive(blob) + by_month[month]
+        records.sort(key=lambda record: record['requested_at'])
+        keys.append(archive_key(user_id, month, instance_id))
+        args += [blob or b'', zlib.compress(serialization.encode(records)), month, len(records)]
+    return bool(get_redis().eval(HISTORY_CAS_SCRIPT, len(keys), *keys, *args))
+
+def update_history(user_id, instance_id, update):
+    """
+    读取、修改并写回用户的邀请码历史，超出保留策略的记录一并移入归档
+
+    历史在读取后被修改时重新读取并重试，签发邀请码和后台整理同时进行时不会互相覆盖。
+
+    参数:
+        update (callable): 接收当前历史列表，返回新的历史列表；返回 None 表示不需要写入
+
+    返回:
+        int: 归档的记录数
+    """
+    key = history_key(user_id, instance_id)
+    while True:
+        history = get_redis().get(key)
+        history_list = update(serialization.decode(history) if history else [])
+        if history_list is None:
+            return 0
+        hot, cold = split_history(history_list)
+        if archive_history(user_id, history, hot, cold, instance_id):
+            return len(cold)
+
+def compact_history(user_id, instance_id=PRIMARY_INSTANCE_ID):
+    """
+    按保留策略整理单个用户的邀请码历史
+
+    返回:
+        int: 归档的记录数
+    """
+    def split_only(history_list):
+        # 没有需要归档的记录时不写入
+        return history_list if history_list and split_history(history_list)[1] else None
+    
+    return update_history(user_id, instance_id, split_only)
+
+def compact_histories(batch_size=500):
+    """
+    整理所有实例、所有用户的邀请码历史
+
+    返回:
+        int: 归档的记录数
+    """
+    archived = 0
+    for key in get_redis().scan_iter(match=f"{INVITE_CODE_PREFIX}*", count=batch_size):
+        instance_id, user_id, suffix = _parse_user_key(key.decode('utf-8')[len(INVITE_CODE_PREFIX):])
+        if user_id.isdigit() and not suffix and instance_id in MISSKEY_INSTANCES:
+            archived += compact_history(int(user_id), instance_id)
+    return archived
+
+@resilience.cached_read
+def get_archive_index(user_id, instance_id=PRIMARY_INSTANCE_ID):
+    """获取用户的归档索引：月份 -> 记录数"""
+    return _decode_archive_index(get_redis_reader().hgetall(archive_index_key(user_id, instance_id)))
+
+@resilience.cached_read
+def get_archived_history(user_id, month, instance_id=PRIMARY_INSTANCE_ID):
+    """获取用户某个月份归档的邀请码历史"""
+    return _decode_archive(get_redis_reader().get(archive_key(user_id, month, instance_id)))
+
+# 待处理邀请码签发相关操作
+@resilience.write_behind
+def save_pending_invite(token, pending):
+    """保存未完成的邀请码签发，服务重启后据此重放"""
+    get_redis().hset(PENDING_INVITES_KEY, token, serialization.encode(pending))
+
+@resilience.write_behind
+def delete_pending_invite(token):
+    """删除已完成的邀请码签发"""
+    get_redis().hdel(PENDING_INVITES_KEY, token)
+
+def get_pending_invites():
+    """获取所有未完成的邀请码签发"""
+    pending_invites = get_redis().hgetall(PENDING_INVITES_KEY)
+    return {token.decode('utf-8'): serialization.decode(pending)
+            for token, pending in pending_invites.items()}
+
+def claim_pending_invite(token, lease_seconds):
+    """抢占待重放的签发，避免多个实例同时重放同一条记录"""
+    return bool(get_redis().set(f"{PENDING_LOCK_PREFIX}{token}", 1, nx=True, ex=lease_seconds))
+
+# 幂等与并发控制相关操作
+# 仅当锁的值与持有者一致时才删除，避免误删其他请求在锁过期后获得的锁
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+def begin_idempotent_request(idempotency_key):
+    """
+    登记一次幂等请求
+
+    返回:
+        dict | None: 首次请求返回 None；重复请求返回已登记的记录，
+        state 为 'pending'（处理中）或 'done'（已完成，包含首次结果）
+    """
+    key = f"{IDEMPOTENCY_PREFIX}{idempotency_key}"
+    pending = serialization.encode({'state': 'pending'})
+    if get_redis().set(key, pending, nx=True, ex=IDEMPOTENCY_TTL_SECONDS):
+        return None
+    return serialization.decode(get_redis().get(key)) or {'state': 'pending'}
+
+@resilience.write_behind
+def complete_idempotent_request(idempotency_key, result):
+    """保存幂等请求的结果，之后的重复请求直接返回该结果"""
+    record = {'state': 'done', **result}
+    get_redis().set(f"{IDEMPOTENCY_PREFIX}{idempotency_key}",
+                    serialization.encode(record), ex=IDEMPOTENCY_TTL_SECONDS)
 
+def release_idempotent_request(idempotency_key):
+    """请求失败时删除幂等记录，允许用户重试"""
+    get_redis().delete(f"{IDEMPOTENCY_PREFIX}{idempotency_key}")
+
+def acquire_invite_lock(user_id):
+    """
+    获取用户的签发锁，同一用户同一时间只允许一个签发在处理中
+
+    返回:
+        str | None: 获取成功时返回锁的持有者标识，否则返回 None
+    """
+    owner = uuid.uuid4().hex
+    if get_redis().set(invite_lock_key(user_id), owner, nx=True, ex=INVITE_LOCK_SECONDS):
+        return owner
+    return None
+
+def release_invite_lock(user_id, owner):
+    """释放用户的签发锁"""
+    get_redis().eval(RELEASE_LOCK_SCRIPT, 1, invite_lock_key(user_id), owner)
+
+# 事件流相关操作
+def append_event(event_type, payload):
+    """
+    追加一条事件到事件流，超出 EVENTS_STREAM_MAXLEN 的旧事件会被裁剪
+
+    返回:
+        str: 事件 ID
+    """
+    fields = {'type': event_type, 'data': serialization.encode(payload)}
+    event_id = get_redis().xadd(EVENTS_STREAM_KEY, fields, maxlen=EVENTS_STREAM_MAXLEN, approximate=True)
+    return event_id.decode('utf-8') if isinstance(event_id, bytes) else event_id
+
+@resilience.write_behind
+def record_event(event_type, user_id, **fields):
+    """记录用户事件（start、captcha），Redis 不可用时暂存等待重放"""
+    append_event(event_type, {'user_id': user_id, 'ts': int(time.time()), **fields})
+
+def ensure_event_group():
+    """创建事件消费者组，已存在时忽略"""
+    try:
+        get_redis().xgroup_create(EVENTS_STREAM_KEY, EVENTS_CONSUMER_GROUP, id='0', mkstream=True)
+    except redis.ResponseError as e:
+        if 'BUSYGROUP' not in str(e):
+            raise
+
+def _decode_events(entries):
+    """把 XREADGROUP/XAUTOCLAIM 返回的条目解码为 (事件 ID, 类型, 内容)"""
+    events = []
+    for event_id, fields in entries:
+        if not fields:
+            # 已被裁剪的事件只剩 ID
+            events.append((event_id.decode('utf-8'), None, None))
+            continue
+        events.append((event_id.decode('utf-8'), fields[b'type'].decode('utf-8'),
+                       serialization.decode(fields[b'data'])))
+    return events
+
+def read_events(consumer, count, block_ms):
+    """读取尚未投递给消费者组的新事件，最多阻塞 block_ms 毫秒"""
+    response = get_redis().xreadgroup(
+        EVENTS_CONSUMER_GROUP, consumer, {EVENTS_STREAM_KEY: '>'}, count=count, block=block_ms
+    )
+    return _decode_events(response[0][1]) if response else []
+
+def claim_stale_events(consumer, min_idle_seconds, count):
+    """接管其他消费者已读取但长时间未确认的事件（例如所在副本已退出）"""
+    response = get_redis().xautoclaim(
+        EVENTS_STREAM_KEY, EVENTS_CONSUMER_GROUP, consumer,
+        min_idle_time=min_idle_seconds * 1000, start_id='0-0', count=count
+    )
+    return _decode_events(response[1])
+
+def ack_event(event_id):
+    """确认事件已处理"""
+    get_redis().xack(EVENTS_STREAM_KEY, EVENTS_CONSUMER_GROUP, event_id)
+
+def event_processed_key(event_id):
+    """已处理事件的标记，与统计键位于同一槽位，可以在同一个脚本中写入"""
+    return stats_key(EVENT_PROCESSED_PREFIX, event_id)
+
+def _day_ttl(day):
+    """某一天的统计剩余的保留时间（秒），该日开始后 STATS_RETENTION_DAYS 天过期，已过期时不大于 0"""
+    expire_at = datetime.combine(day, datetime.min.time()) + timedelta(days=STATS_RETENTION_DAYS)
+    return int(expire_at.timestamp() - time.time())
+
+# 活动计数脚本：检查并写入事件标记、累加计数，在服务端原子执行，重复投递的事件不会重复计入
+ACTIVITY_SCRIPT = """
+if ARGV[4] == '1' then
+    if redis.call('EXISTS', KEYS[2]) == 1 then
+        return 0
+    end
+    redis.call('SET', KEYS[2], 1, 'EX', ARGV[3])
+end
+if tonumber(ARGV[2]) > 0 then
+    redis.call('HINCRBY', KEYS[1], ARGV[1], 1)
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 1
+"""
+
+def increment_activity(day, field, event_id=None):
+    """
+    累加某一天的用户活动计数（start、验证码等）
+
+    参数:
+        day (date): 活动所在日期，超出保留期的日期不再计入
+        field (str): 计数字段
+        event_id (str): 来源事件 ID，同一事件只计入一次
+
+    返回:
+        bool: 是否计入（重复的事件返回 False）
+    """
+    keys = [stats_key(STATS_ACTIVITY_PREFIX, day.strftime('%Y-%m-%d')), event_processed_key(event_id or '')]
+    applied = get_redis().eval(
+        ACTIVITY_SCRIPT, len(keys), *keys,
+        field, _day_ttl(day), EVENT_DEDUPE_TTL_SECONDS, 1 if event_id else 0
+    )
+    return bool(applied)
+
+def get_activity_stats(days=7):
+    """获取最近 days 天的用户活动计数合计"""
+    today = datetime.now().date()
+    pipe = get_redis_reader().pipeline(transaction=False)
+    for i in range(days):
+        pipe.hgetall(stats_key(STATS_ACTIVITY_PREFIX, (today - timedelta(days=i)).strftime('%Y-%m-%d')))
+    totals = {}
+    for counts in pipe.execute():
+        for field, count in counts.items():
+            field = field.decode('utf-8')
+            totals[field] = totals.get(field, 0) + int(count)
+    return totals
+
+# 统计相关操作
+# 邀请码统计脚本：检查并写入邀请码标记、更新每日统计，在服务端原子执行。
+# 多个消费者并发更新同一天的统计不会丢失计数，同一个邀请码只计入一次；
+# 已折叠或超出保留期的日期同时直接计入周、月汇总，迟到的事件不会从汇总中丢失
+INVITE_STATS_SCRIPT = """
+if redis.call('EXISTS', KEYS[5]) == 1 then
+    return 0
+end
+redis.call('SET', KEYS[5], 1, 'EX', ARGV[4])
+local admin_field = ARGV[2] == '1' and 'admin_invites' or 'user_invites'
+local ttl = tonumber(ARGV[3])
+if ttl > 0 then
+    local raw = redis.call('GET', KEYS[1])
+    local stats
+    if raw then
+        -- 去掉版本 2 记录的版本标记，内容与版本 1 一样是 JSON
+        if string.byte(raw, 1) == 2 then
+            raw = string.sub(raw, 2)
+        end
+        stats = cjson.decode(raw)
+    else
+        stats = {total_invites = 0, admin_invites = 0, user_invites = 0, users = {}}
+    end
+    stats['total_invites'] = stats['total_invites'] + 1
+    stats[admin_field] = stats[admin_field] + 1
+    stats['users'][ARGV[1]] = (stats['users'][ARGV[1]] or 0) + 1
+    redis.call('SET', KEYS[1], '\\2' .. cjson.encode(stats), 'EX', ttl)
+end
+if ttl <= 0 or redis.call('EXISTS', KEYS[4]) == 1 then
+    for i = 2, 3 do
+        redis.call('HINCRBY', KEYS[i], 'total_invites', 1)
+        redis.call('HINCRBY', KEYS[i], admin_field, 1)
+        redis.call('HINCRBY', KEYS[i], 'user:' .. ARGV[1], 1)
+    end
+end
+return 1
+"""
+
+def update_invite_stats(invite_code, user_id, is_admin, now=None, instance_id=PRIMARY_INSTANCE_ID):
+    """
+    更新邀请码统计信息，计入 now（默认为当前时间）所在日期
+
+    每日统计在该日开始后 STATS_RETENTION_DAYS 天过期，超出保留期的日期只计入周、月汇总。
+    按 实例 ID + 邀请码 去重：记录邀请码被重放、追加了多条事件时也只计入一次。
+
+    返回:
+        bool: 是否计入（重复的邀请码返回 False）
+    """
+    day = (now or datetime.now()).date()
+    date_str = day.strftime('%Y-%m-%d')
+    keys = [
+        stats_key(STATS_PREFIX, date_str),
+        stats_key(STATS_WEEKLY_PREFIX, _week_label(day)),
+        stats_key(STATS_MONTHLY_PREFIX, _month_label(day)),
+        stats_key(STATS_ROLLUP_MARK_PREFIX, date_str),
+        event_processed_key(f"invite:{instance_id}:{invite_code}")
+    ]
+    applied = get_redis().eval(
+        INVITE_STATS_SCRIPT, len(keys), *keys,
+        str(user_id), 1 if is_admin else 0, _day_ttl(day), EVENT_DEDUPE_TTL_SECONDS
+    )
+    if applied:
+        # 递增统计版本号，用于图表缓存失效
+        get_redis().incr(STATS_VERSION_KEY)
+    return bool(applied)
+
+@resilience.cached_read
 def get_invite_stats(days=7):
     """获取最近几天的邀请码统计信息"""
     stats = []
     
-    # 获取最近几天的日期
-    for i in range(days):
-        date = (datetime.now() - timedelta(days=i)).strftime('%Y-%m-%d')
-        stats_key = f"{STATS_PREFIX}{date}"
-        
+    # 获取最近几天的日期，通过一次管道读取
+    dates = [(datetime.now() - timedelta(days=i)).strftime('%Y-%m-%d') for i in range(days)]
+    pipe = get_redis_reader().pipeline(transaction=False)
+    for date in dates:
+        pipe.get(stats_key(STATS_PREFIX, date))
+    
+    for date, stats_data in zip(dates, pipe.execute()):
         # 获取该日的统计数据
-        stats_data = redis_client.get(stats_key)
         if stats_data:
-            day_stats = json.loads(stats_data)
+            day_stats = serialization.decode(stats_data)
             day_stats['date'] = date
             stats.append(day_stats)
         else:
@@ -195,4 +728,297 @@ def get_invite_stats(days=7):
                 'users': {}
             })
     
-    return stats 
\ No newline at end of file
+    return stats
+
+def iter_weekly_stats(start_date, end_date, batch_size=52):
+    """
+    按时间正序逐周迭代周汇总，包含开始、结束日期所在的整周，跳过没有数据的周
+
+    参数:
+        start_date (date): 开始日期
+        end_date (date): 结束日期
+        batch_size (int): 每次管道读取的周数
+
+    返回:
+        generator: 每周的统计，date 为该周的周一
+    """
+    week = start_date - timedelta(days=start_date.weekday())
+    while week <= end_date:
+        batch = []
+        while week <= end_date and len(batch) < batch_size:
+            batch.append(week)
+            week += timedelta(weeks=1)
+        
+        pipe = get_redis_reader().pipeline(transaction=False)
+        for monday in batch:
+            pipe.hgetall(stats_key(STATS_WEEKLY_PREFIX, _week_label(monday)))
+        
+        for monday, rollup in zip(batch, pipe.execute()):
+            if not rollup:
+                continue
+            rollup = {key.decode('utf-8'): int(value) for key, value in rollup.items()}
+            yield {
+                'date': monday.strftime('%Y-%m-%d'),
+                'total_invites': rollup.get('total_invites', 0),
+                'admin_invites': rollup.get('admin_invites', 0),
+                'user_invites': rollup.get('user_invites', 0),
+                'users': {key[len('user:'):]: value for key, value in rollup.items()
+                          if key.startswith('user:')}
+            }
+
+def iter_daily_stats(start_date, end_date, batch_size=31):
+    """
+    按日期正序逐日迭代统计信息，跳过没有数据的日期
+
+    每批日期通过一次管道读取，内存占用与日期范围无关。
+
+    参数:
+        start_date (date): 开始日期（含）
+        end_date (date): 结束日期（含）
+        batch_size (int): 每次管道读取的天数
+    """
+    day = start_date
+    while day <= end_date:
+        batch = []
+        while day <= end_date and len(batch) < batch_size:
+            batch.append(day.strftime('%Y-%m-%d'))
+            day += timedelta(days=1)
+        
+        pipe = get_redis_reader().pipeline(transaction=False)
+        for date in batch:
+            pipe.get(stats_key(STATS_PREFIX, date))
+        
+        for date, stats_data in zip(batch, pipe.execute()):
+            if stats_data:
+                day_stats = serialization.decode(stats_data)
+                day_stats['date'] = date
+                yield day_stats
+
+def get_stats_version():
+    """获取统计版本号，每次统计更新后都会变化"""
+    version = get_redis_reader().get(STATS_VERSION_KEY)
+    return int(version) if version else 0
+
+# 图表缓存相关操作
+def get_cached_chart(cache_key):
+    """获取缓存的图表图片"""
+    return get_redis_reader().get(f"{CHART_CACHE_PREFIX}{cache_key}")
+
+def cache_chart(cache_key, image, expiry_seconds):
+    """缓存渲染好的图表图片"""
+    get_redis().setex(f"{CHART_CACHE_PREFIX}{cache_key}", expiry_seconds, image)
+
+# 统计汇总相关操作
+def _week_label(day):
+    """返回日期所在的 ISO 周标签，例如 2024-W05"""
+    year, week, _ = day.isocalendar()
+    return f"{year}-W{week:02d}"
+
+def _month_label(day):
+    """返回日期所在的月份标签，例如 2024-02"""
+    return day.strftime('%Y-%m')
+
+# 折叠脚本：检查折叠标记、读取每日统计、累加到周和月汇总、写入标记，在服务端原子执行；
+# 没有统计的日期不写入标记，之后出现的统计仍会被折叠
+ROLLUP_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+local raw = redis.call('GET', KEYS[2])
+if not raw then
+    return 0
+end
+-- 去掉版本 2 记录的版本标记，内容与版本 1 一样是 JSON
+if string.byte(raw, 1) == 2 then
+    raw = string.sub(raw, 2)
+end
+local stats = cjson.decode(raw)
+for i = 3, 4 do
+    redis.call('HINCRBY', KEYS[i], 'total_invites', stats['total_invites'])
+    redis.call('HINCRBY', KEYS[i], 'admin_invites', stats['admin_invites'])
+    redis.call('HINCRBY', KEYS[i], 'user_invites', stats['user_invites'])
+    for user_id, count in pairs(stats['users']) do
+        redis.call('HINCRBY', KEYS[i], 'user:' .. user_id, count)
+    end
+end
+redis.call('SET', KEYS[1], 1, 'EX', ARGV[1])
+return 1
+"""
+
+def rollup_daily_stats(day):
+    """
+    将某一天的统计折叠进周、月汇总
+
+    每天只会被折叠一次，折叠标记的保留时间长于每日统计的保留时间；没有统计的日期不会被标记。
+    折叠在 Lua 脚本中原子执行，多个实例同时执行时不会重复计数；
+    开启哈希标签后脚本涉及的键位于同一槽位，集群模式下同样可用。
+
+    返回:
+        bool: 本次是否执行了折叠
+    """
+    date_str = day.strftime('%Y-%m-%d')
+    keys = [
+        stats_key(STATS_ROLLUP_MARK_PREFIX, date_str),
+        stats_key(STATS_PREFIX, date_str),
+        stats_key(STATS_WEEKLY_PREFIX, _week_label(day)),
+        stats_key(STATS_MONTHLY_PREFIX, _month_label(day))
+    ]
+    folded = get_redis().eval(
+        ROLLUP_SCRIPT, len(keys), *keys, (STATS_RETENTION_DAYS + 1) * 24 * 60 * 60
+    )
+    return bool(folded)
+
+def rollup_stats():
+    """
+    把保留期内结束超过 STATS_ROLLUP_DELAY_DAYS 天的日期折叠进周、月汇总
+
+    返回:
+        int: 本次折叠的天数
+    """
+    today = datetime.now().date()
+    folded = 0
+    for i in range(max(STATS_ROLLUP_DELAY_DAYS, 1), STATS_RETENTION_DAYS + 1):
+        if rollup_daily_stats(today - timedelta(days=i)):
+            folded += 1
+    return folded
+
+def _rollup_labels(period, count):
+    """生成最近 count 个周期的标签（从当前周期开始倒序）"""
+    today = datetime.now().date()
+    if period == 'week':
+        return [_week_label(today - timedelta(weeks=i)) for i in range(count)]
+
+    labels = []
+    year, month = today.year, today.month
+    for _ in range(count):
+        labels.append(f"{year}-{month:02d}")
+        month -= 1
+        if month == 0:
+            year, month = year - 1, 12
+    return labels
+
+def get_rollup_stats(period='week', count=12):
+    """
+    从周、月汇总中获取最近几个周期的统计信息
+
+    所有汇总键与最近几天的统计在一次管道往返中读取，读取次数与时间跨度无关。
+    今日和最近尚未折叠的日期的统计会计入所在的周期。
+
+    参数:
+        period (str): 'week' 或 'month'
+        count (int): 周期数量
+
+    返回:
+        list: 每个周期的统计，按时间倒序
+    """
+    prefix = STATS_WEEKLY_PREFIX if period == 'week' else STATS_MONTHLY_PREFIX
+    labels = _rollup_labels(period, count)
+
+    label_of = _week_label if period == 'week' else _month_label
+    today = datetime.now().date()
+    # 折叠任务可能尚未处理到的日期：今日和最近 STATS_ROLLUP_DELAY_DAYS 天
+    recent_days = [today - timedelta(days=i) for i in range(STATS_ROLLUP_DELAY_DAYS + 1)]
+
+    pipe = get_redis_reader().pipeline(transaction=False)
+    for label in labels:
+        pipe.hgetall(stats_key(prefix, label))
+    for day in recent_days:
+        date_str = day.strftime('%Y-%m-%d')
+        pipe.get(stats_key(STATS_PREFIX, date_str))
+        pipe.exists(stats_key(STATS_ROLLUP_MARK_PREFIX, date_str))
+    results = pipe.execute()
+    rollups, recent = results[:len(labels)], results[len(labels):]
+
+    stats = []
+    for label, rollup in zip(labels, rollups):
+        rollup = {key.decode('utf-8'): int(value) for key, value in rollup.items()}
+        stats.append({
+            'period': label,
+            'total_invites': rollup.get('total_invites', 0),
+            'admin_invites': rollup.get('admin_invites', 0),
+            'user_invites': rollup.get('user_invites', 0),
+            'users': {key[len('user:'):]: value for key, value in rollup.items()
+                      if key.startswith('user:')}
+        })
+
+    # 合并尚未折叠的日期的统计
+    by_label = {period_stats['period']: period_stats for period_stats in stats}
+    for day, day_stats, folded in zip(recent_days, recent[::2], recent[1::2]):
+        current = by_label.get(label_of(day))
+        if not day_stats or folded or current is None:
+            continue
+        day_data = serialization.decode(day_stats)
+        current['total_invites'] += day_data['total_invites']
+        current['admin_invites'] += day_data['admin_invites']
+        current['user_invites'] += day_data['user_invites']
+        for user_id_str, user_count in day_data['users'].items():
+            current['users'][user_id_str] = current['users'].get(user_id_str, 0) + user_count
+
+    return stats
+
+# 键布局迁移
+def _move_key(client, key, new_key):
+    """复制键（保留过期时间）后删除旧键，新旧键可以位于不同槽位"""
+    if new_key == key:
+        return False
+    ttl = client.pttl(key)
+    dumped = client.dump(key)
+    if dumped is None:
+        return False
+    client.restore(new_key, max(ttl, 0), dumped, replace=True)
+    client.delete(key)
+    return True
+
+def migrate_key_layout(batch_size=500):
+    """
+    把旧布局的键改写为当前布局（开启或关闭哈希标签后执行一次）
+
+    逐个键复制后删除旧键，在集群中也可以执行。
+
+    返回:
+        int: 迁移的键数量
+    """
+    client = get_redis()
+    migrated = 0
+    builders = [
+        (USER_PREFIX, user_key),
+        (CAPTCHA_PREFIX, captcha_key)
+    ]
+    for prefix, build_key in builders:
+        for key in client.scan_iter(match=f"{prefix}*", count=batch_size):
+            key = key.decode('utf-8')
+            value = key[len(prefix):].strip('{}')
+            if value.isdigit() and _move_key(client, key, build_key(value)):
+                migrated += 1
+    
+    for key in client.scan_iter(match=f"{INVITE_CODE_PREFIX}*", count=batch_size):
+        key = key.decode('utf-8')
+        instance_id, value, suffix = _parse_user_key(key[len(INVITE_CODE_PREFIX):])
+        if value.isdigit() and not suffix and _move_key(client, key, history_key(value, instance_id)):
+            migrated += 1
+    
+    for key in client.scan_iter(match=f"{INVITE_ARCHIVE_PREFIX}*", count=batch_size):
+        key = key.decode('utf-8')
+        instance_id, value, month = _parse_user_key(key[len(INVITE_ARCHIVE_PREFIX):])
+        if not value.isdigit():
+            continue
+        if month:
+            new_key = archive_key(value, month, instance_id)
+        else:
+            new_key = archive_index_key(value, instance_id)
+        if _move_key(client, key, new_key):
+            migrated += 1
+    
+    stats_prefixes = [STATS_WEEKLY_PREFIX, STATS_MONTHLY_PREFIX,
+                      STATS_ROLLUP_MARK_PREFIX, STATS_ACTIVITY_PREFIX, STATS_PREFIX]
+    for key in client.scan_iter(match=f"{STATS_PREFIX}*", count=batch_size):
+        key = key.decode('utf-8')
+        if key in (STATS_VERSION_KEY, STATS_LAST_UPDATED_KEY):
+            continue
+        # 按最长前缀匹配键类型
+        prefix = next(p for p in stats_prefixes if key.startswith(p))
+        label = key[len(prefix):].replace(STATS_HASH_TAG, '')
+        if _move_key(client, key, stats_key(prefix, label)):
+            migrated += 1
+    
+    return migrated
@@ -0,0 +1,85 @@
+"""
+事件消费服务
+
+邀请码、验证码和 /start 事件由处理器追加到 Redis Stream，处理器只负责必要的写入；
+统计和活动汇总由这里的消费者组异步构建。
+
+投递语义为至少一次：事件处理完成后才确认，副本在确认前退出时，事件会在
+EVENTS_CLAIM_IDLE_SECONDS 后被其他消费者接管重新处理。每个处理器在同一个 Lua 脚本中
+写入去重标记和统计（邀请码事件按 实例 ID + 邀请码，其他事件按事件 ID），
+重复投递或重复追加的事件不会重复计入。
+"""
+import os
+import socket
+from datetime import datetime
+
+from loguru import logger
+
+from app.config.settings import EVENTS_BATCH_SIZE, EVENTS_CLAIM_IDLE_SECONDS, PRIMARY_INSTANCE_ID
+from app.services import database as db
+from app.services import resilience
+
+# 消费者名称，每个进程一个
+CONSUMER_NAME = f"{socket.gethostname()}-{os.getpid()}"
+
+def _day_of(payload):
+    return datetime.fromtimestamp(payload['ts']).date()
+
+def handle_invite(event_id, payload):
+    """邀请码事件：计入当天的邀请码统计，按邀请码去重，同一邀请码的多条事件只计入一次"""
+    db.update_invite_stats(
+        payload['invite_code'], payload['user_id'], payload['is_admin'],
+        datetime.fromtimestamp(payload['ts']), payload.get('instance_id', PRIMARY_INSTANCE_ID)
+    )
+
+def handle_start(event_id, payload):
+    """/start 事件：计入当天的活动统计"""
+    db.increment_activity(_day_of(payload), 'start', event_id=event_id)
+
+def handle_captcha(event_id, payload):
+    """验证码事件：按结果（issued、passed、failed、throttled）计入当天的活动统计"""
+    db.increment_activity(_day_of(payload), f"captcha_{payload['result']}", event_id=event_id)
+
+HANDLERS = {
+    'invite': handle_invite,
+    'start': handle_start,
+    'captcha': handle_captcha
+}
+
+def process_events(events):
+    """
+    处理并确认一批事件
+
+    处理器出错的事件记录日志后跳过；Redis 错误会向上抛出，
+    未确认的事件之后会被重新投递。
+
+    返回:
+        int: 确认的事件数量
+    """
+    acked = 0
+    for event_id, event_type, payload in events:
+        if event_type is not None:
+            handler = HANDLERS.get(event_type)
+            try:
+                if handler:
+                    handler(event_id, payload)
+                else:
+                    logger.warning(f"未知的事件类型 {event_type}，事件 {event_id}")
+            except resilience.REDIS_ERRORS:
+                raise
+            except Exception as e:
+                logger.error(f"处理事件 {event_id} 时出错，已跳过: {e}")
+        db.ack_event(event_id)
+        acked += 1
+    return acked
+
+def consume_once(block_ms=1000):
+    """
+    接管超时未确认的事件，再读取新事件并处理
+
+    返回:
+        int: 确认的事件数量
+    """
+    events = db.claim_stale_events(CONSUMER_NAME, EVENTS_CLAIM_IDLE_SECONDS, EVENTS_BATCH_SIZE)
+    events += db.read_events(CONSUMER_NAME, EVENTS_BATCH_SIZE, block_ms)
+    return process_events(events)
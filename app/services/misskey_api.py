@@ -4,47 +4,70 @@ Misskey API 服务
 import requests
 import logging
 from datetime import datetime, timedelta
+from functools import lru_cache
+
+from requests.adapters import HTTPAdapter
 
 from app.config.settings import (
-    MISSKEY_API_URL, MISSKEY_API_TOKEN, INVITE_CODE_EXPIRY_DAYS
+    MISSKEY_API_TIMEOUT, MISSKEY_POOL_SIZE, MISSKEY_INSTANCES, PRIMARY_INSTANCE_ID
 )
 
 # 配置日志
 logger = logging.getLogger(__name__)
 
-def create_invite_code(is_admin=False):
+def get_instance(instance_id=PRIMARY_INSTANCE_ID):
+    """
+    获取实例配置
+    
+    参数:
+        instance_id (str): 实例 ID
+    
+    返回:
+        dict: 实例配置，实例不存在时抛出 KeyError
+    """
+    return MISSKEY_INSTANCES[instance_id]
+
+@lru_cache(maxsize=None)
+def get_session(instance_id=PRIMARY_INSTANCE_ID):
+    """
+    获取实例的 HTTP 会话，每个实例一个独立的连接池，连接在请求之间复用
+    
+    返回:
+        requests.Session: 实例的会话
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=MISSKEY_POOL_SIZE)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({"Content-Type": "application/json"})
+    return session
+
+def create_invite_code(is_admin=False, instance_id=PRIMARY_INSTANCE_ID):
     """
     通过 Misskey API 创建邀请码
     
     参数:
         is_admin (bool): 是否为管理员创建的邀请码，管理员创建的邀请码可以永久有效
+        instance_id (str): 实例 ID
     
     返回:
         dict: 包含邀请码和过期时间的字典
     """
-    if not MISSKEY_API_URL or not MISSKEY_API_TOKEN:
-        raise ValueError("Misskey API URL 或 Token 未设置")
+    instance = get_instance(instance_id)
+    if not instance['api_url'] or not instance['api_token']:
+        raise ValueError(f"实例 {instance_id} 的 Misskey API URL 或 Token 未设置")
     
     # 计算过期时间，管理员可以创建永久邀请码
     if is_admin:
         expiry_date = None
     else:
-        expiry_date = datetime.now() + timedelta(days=INVITE_CODE_EXPIRY_DAYS)
+        expiry_date = datetime.now() + timedelta(days=instance['invite_expiry_days'])
     
     # 准备请求数据
-    # 根据示例代码，使用 /api/invite/create 端点
-    # 并使用 count 和 expiresAt 参数
-    url = f"{MISSKEY_API_URL}/invite/create"
-    
-    # 如果 MISSKEY_API_URL 不包含 /api，则添加
-    if not url.endswith('/invite/create'):
-        if not MISSKEY_API_URL.endswith('/'):
-            url = f"{MISSKEY_API_URL}/api/invite/create"
-        else:
-            url = f"{MISSKEY_API_URL}api/invite/create"
+    url = get_invite_create_url(instance_id)
     
     data = {
-        "i": MISSKEY_API_TOKEN,  # 认证令牌
+        "i": instance['api_token'],  # 认证令牌
         "count": 1,              # 生成一个邀请码
     }
     
@@ -52,12 +75,10 @@ def create_invite_code(is_admin=False):
     if expiry_date:
         data["expiresAt"] = expiry_date.isoformat()
     
-    headers = {"Content-Type": "application/json"}
-    
     # 发送请求创建邀请码
     try:
         logger.info(f"正在请求邀请码: {url}")
-        response = requests.post(url, json=data, headers=headers)
+        response = get_session(instance_id).post(url, json=data, timeout=MISSKEY_API_TIMEOUT)
         response.raise_for_status()  # 如果请求失败，抛出异常
         
         # 解析响应
@@ -92,38 +113,52 @@ def create_invite_code(is_admin=False):
         logger.error(f"处理邀请码响应时出错: {e}")
         return None
 
-def get_invite_code_url(code):
+@lru_cache(maxsize=None)
+def get_invite_create_url(instance_id=PRIMARY_INSTANCE_ID):
+    """
+    获取创建邀请码的 API 地址，只在首次调用时计算
+    
+    返回:
+        str: /api/invite/create 端点的完整 URL
+    """
+    api_url = get_instance(instance_id)['api_url']
+    
+    # 根据示例代码，使用 /api/invite/create 端点
+    # 并使用 count 和 expiresAt 参数
+    url = f"{api_url}/invite/create"
+    
+    # 如果 API 地址不包含 /api，则添加
+    if not url.endswith('/invite/create'):
+        if not api_url.endswith('/'):
+            url = f"{api_url}/api/invite/create"
+        else:
+            url = f"{api_url}api/invite/create"
+    
+    return url
+
+def get_invite_code_url(code, instance_id=PRIMARY_INSTANCE_ID):
     """
     获取邀请码的完整URL
     
     参数:
         code (str): 邀请码
+        instance_id (str): 实例 ID
         
     返回:
         str: 邀请码的完整URL
     """
-    # 从API URL中提取实例域名
-    instance_url = MISSKEY_API_URL
-    
-    # 移除 /api 部分以获取实例根URL
-    if '/api' in instance_url:
-        instance_url = instance_url.split('/api')[0]
-    
-    # 确保没有尾随斜杠
-    if instance_url.endswith('/'):
-        instance_url = instance_url[:-1]
-    
-    return f"{instance_url}/?invitation={code}"
+    return f"{get_instance_url(instance_id)}/?invitation={code}"
 
-def get_instance_url():
+@lru_cache(maxsize=None)
+def get_instance_url(instance_id=PRIMARY_INSTANCE_ID):
     """
-    获取 Misskey 实例的 URL
+    获取 Misskey 实例的 URL，只在首次调用时从 API URL 推导
     
     返回:
         str: 实例的完整 URL
     """
     # 从 API URL 中提取实例域名
-    instance_url = MISSKEY_API_URL
+    instance_url = get_instance(instance_id)['api_url']
     
     # 移除 /api 部分以获取实例根 URL
     if '/api' in instance_url:
@@ -133,4 +168,4 @@ def get_instance_url():
     if instance_url.endswith('/'):
         instance_url = instance_url[:-1]
     
-    return instance_url 
\ No newline at end of file
+    return instance_url
@@ -0,0 +1,96 @@
+"""
+Redis 连接服务
+"""
+import redis
+from redis.backoff import ExponentialBackoff
+from redis.retry import Retry
+
+from app.config.settings import (
+    REDIS_URL, REDIS_MODE, REDIS_SENTINELS, REDIS_SENTINEL_MASTER, REDIS_SENTINEL_PASSWORD,
+    REDIS_PASSWORD, REDIS_DB, REDIS_READ_FROM_REPLICAS, REDIS_REPLICA_URL,
+    REDIS_CONNECT_TIMEOUT, REDIS_SOCKET_TIMEOUT
+)
+
+# 连接断开或超时时重试，主从切换期间请求不会直接失败
+RETRY_ERRORS = [redis.ConnectionError, redis.TimeoutError]
+
+# 连接和读写超时，网络丢包时请求不会一直阻塞事件循环。
+# 不使用 health_check_interval：redis-py 5.0.1 在建立连接时执行健康检查，
+# 服务端无响应时会经由重试策略递归重连，超时无法生效；失效的连接由读超时和重试处理
+TIMEOUTS = {
+    'socket_connect_timeout': REDIS_CONNECT_TIMEOUT,
+    'socket_timeout': REDIS_SOCKET_TIMEOUT
+}
+
+def _retry():
+    """创建连接重试策略"""
+    return Retry(ExponentialBackoff(cap=2, base=0.1), 5)
+
+def _parse_nodes(nodes):
+    """解析逗号分隔的 host:port 列表"""
+    parsed = []
+    for node in nodes.split(','):
+        node = node.strip()
+        if node:
+            host, _, port = node.rpartition(':')
+            parsed.append((host, int(port)))
+    return parsed
+
+def create_redis_clients(url=None):
+    """
+    根据 REDIS_MODE 创建 Redis 客户端
+
+    参数:
+        url (str): Redis 连接 URL，单节点和集群模式下使用，默认使用 REDIS_URL
+
+    返回:
+        tuple: (主节点客户端, 只读查询客户端)，未开启副本读取时两者相同
+    """
+    url = url or REDIS_URL
+
+    if REDIS_MODE == 'sentinel':
+        from redis.sentinel import Sentinel
+
+        sentinel = Sentinel(
+            _parse_nodes(REDIS_SENTINELS),
+            sentinel_kwargs={'password': REDIS_SENTINEL_PASSWORD, **TIMEOUTS},
+            password=REDIS_PASSWORD,
+            db=REDIS_DB,
+            retry=_retry(),
+            retry_on_error=RETRY_ERRORS,
+            **TIMEOUTS
+        )
+        primary = sentinel.master_for(REDIS_SENTINEL_MASTER)
+        # 没有可用副本时会自动回退到主节点
+        reader = sentinel.slave_for(REDIS_SENTINEL_MASTER) if REDIS_READ_FROM_REPLICAS else primary
+        return primary, reader
+
+    if REDIS_MODE == 'cluster':
+        from redis.cluster import RedisCluster
+
+        primary = RedisCluster.from_url(url, password=REDIS_PASSWORD, retry=_retry(), **TIMEOUTS)
+        reader = primary
+        if REDIS_READ_FROM_REPLICAS:
+            reader = RedisCluster.from_url(
+                url, password=REDIS_PASSWORD, retry=_retry(), read_from_replicas=True, **TIMEOUTS
+            )
+        return primary, reader
+
+    if REDIS_MODE != 'standalone':
+        raise ValueError(f"不支持的 REDIS_MODE: {REDIS_MODE}")
+
+    primary = redis.from_url(
+        url,
+        retry=_retry(),
+        retry_on_error=RETRY_ERRORS,
+        **TIMEOUTS
+    )
+    reader = primary
+    if REDIS_READ_FROM_REPLICAS and REDIS_REPLICA_URL:
+        reader = redis.from_url(
+            REDIS_REPLICA_URL,
+            retry=_retry(),
+            retry_on_error=RETRY_ERRORS,
+            **TIMEOUTS
+        )
+    return primary, reader
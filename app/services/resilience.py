@@ -0,0 +1,152 @@
+"""
+Redis 降级运行服务
+
+Redis 短暂不可用时：
+    - 带 write_behind 的写操作（用户信息、邀请码记录和统计、签发记录）暂存在内存日志中，
+      Redis 恢复后按写入顺序重放，已经在 Misskey 上生成的邀请码不会丢失记录
+    - 带 cached_read 的读操作返回最近一次成功读取的结果
+    - HEALTH 记录当前状态，供 /health 命令查看
+
+日志只保存在内存中，进程在 Redis 恢复前退出时日志会丢失；日志已满时新的写入被丢弃并记录日志。
+"""
+import collections
+import copy
+import functools
+import threading
+import time
+
+import redis
+from loguru import logger
+
+from app.config.settings import (
+    DEGRADED_JOURNAL_MAX_ENTRIES, DEGRADED_CACHE_MAX_ENTRIES, DEGRADED_CACHE_TTL_SECONDS
+)
+
+# 视为 Redis 不可用的错误
+REDIS_ERRORS = (redis.ConnectionError, redis.TimeoutError)
+
+# 待重放的写操作：(函数, 位置参数, 关键字参数, 写入时间)
+JOURNAL = collections.deque()
+
+# 最近的读取结果：调用参数 -> (结果, 读取时间)
+READ_CACHE = collections.OrderedDict()
+_cache_lock = threading.Lock()
+_MISSING = object()
+
+# 运行状态
+HEALTH = {
+    'redis_available': True,
+    'degraded_since': None,
+    'last_error': None,
+    'dropped_writes': 0,
+    'replayed_writes': 0,
+    'cache_hits': 0
+}
+
+def mark_unavailable(error):
+    """记录 Redis 不可用，进入降级模式"""
+    if HEALTH['redis_available']:
+        logger.error(f"Redis 不可用，进入降级模式: {error}")
+        HEALTH.update(redis_available=False, degraded_since=time.time())
+    HEALTH['last_error'] = str(error)
+
+def mark_available():
+    """记录 Redis 已恢复"""
+    if not HEALTH['redis_available']:
+        logger.info(f"Redis 已恢复，降级持续 {time.time() - HEALTH['degraded_since']:.0f} 秒")
+        HEALTH.update(redis_available=True, degraded_since=None)
+
+def is_degraded():
+    """Redis 不可用，或者仍有未重放的写操作"""
+    return not HEALTH['redis_available'] or bool(JOURNAL)
+
+def _journal(func, args, kwargs):
+    if len(JOURNAL) >= DEGRADED_JOURNAL_MAX_ENTRIES:
+        HEALTH['dropped_writes'] += 1
+        logger.error(f"降级日志已满，丢弃写操作 {func.__name__}{args}")
+        return
+    # 复制参数，调用方之后修改参数对象不影响重放
+    JOURNAL.append((func, copy.deepcopy(args), copy.deepcopy(kwargs), time.time()))
+
+def write_behind(func):
+    """
+    包装写操作：Redis 不可用时把写操作暂存到日志中，返回 None
+
+    只能用于不会被其他带 write_behind 的函数调用的顶层写操作，
+    否则重放时内层写操作会再次进入日志。
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        # 日志未重放完之前的写操作也进入日志，保证写入顺序
+        if is_degraded():
+            _journal(func, args, kwargs)
+            return None
+        try:
+            return func(*args, **kwargs)
+        except REDIS_ERRORS as e:
+            mark_unavailable(e)
+            _journal(func, args, kwargs)
+            return None
+    return wrapper
+
+def _get_cached(key):
+    with _cache_lock:
+        entry = READ_CACHE.get(key)
+    if entry is None or time.time() - entry[1] > DEGRADED_CACHE_TTL_SECONDS:
+        return _MISSING
+    HEALTH['cache_hits'] += 1
+    return entry[0]
+
+def _set_cached(key, result):
+    with _cache_lock:
+        READ_CACHE[key] = (result, time.time())
+        READ_CACHE.move_to_end(key)
+        while len(READ_CACHE) > DEGRADED_CACHE_MAX_ENTRIES:
+            READ_CACHE.popitem(last=False)
+
+def cached_read(func):
+    """
+    包装读操作：每次成功读取都缓存结果，Redis 不可用时返回缓存的结果
+
+    降级期间有缓存时直接返回，不再等待连接重试；没有缓存时仍然尝试读取。
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        key = repr((func.__name__, args, kwargs))
+        if not HEALTH['redis_available']:
+            cached = _get_cached(key)
+            if cached is not _MISSING:
+                return cached
+        try:
+            result = func(*args, **kwargs)
+        except REDIS_ERRORS as e:
+            mark_unavailable(e)
+            cached = _get_cached(key)
+            if cached is _MISSING:
+                raise
+            return cached
+        _set_cached(key, result)
+        return result
+    return wrapper
+
+def replay_journal():
+    """
+    按写入顺序重放日志中的写操作，Redis 再次不可用时停止
+
+    返回:
+        int: 重放的写操作数量
+    """
+    replayed = 0
+    while JOURNAL:
+        func, args, kwargs, _ = JOURNAL[0]
+        try:
+            func(*args, **kwargs)
+        except REDIS_ERRORS as e:
+            mark_unavailable(e)
+            break
+        except Exception as e:
+            logger.error(f"重放写操作 {func.__name__}{args} 失败，已丢弃: {e}")
+        JOURNAL.popleft()
+        replayed += 1
+    HEALTH['replayed_writes'] += replayed
+    return replayed
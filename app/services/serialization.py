@@ -0,0 +1,73 @@
+"""
+记录序列化服务
+
+Redis 中的记录（用户、邀请码历史、统计、待处理签发）统一通过这里编码和解码。
+
+格式:
+    版本 1: 标准 JSON，时间为 ISO-8601 字符串（旧格式，只读）
+    版本 2: 1 字节版本标记 + orjson 编码的 JSON，时间为整数时间戳（秒）
+
+读取时自动识别版本，版本 1 的时间字段会被转换为整数时间戳，
+调用方始终得到相同结构的记录；记录在下次写入时以版本 2 保存，实现在线迁移。
+"""
+from datetime import datetime
+
+import orjson
+
+FORMAT_VERSION = 2
+VERSION_TAG = bytes([FORMAT_VERSION])
+
+# 需要在旧格式中从 ISO-8601 转换为时间戳的字段
+TIMESTAMP_FIELDS = ('registered_at', 'requested_at', 'expires_at')
+
+def to_timestamp(value):
+    """把 datetime 或 ISO-8601 字符串转换为整数时间戳，None 保持不变"""
+    if value is None or isinstance(value, (int, float)):
+        return value
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    return int(value.timestamp())
+
+def encode(record):
+    """
+    把记录编码为当前版本的字节串
+
+    参数:
+        record (dict | list): 记录或记录列表
+
+    返回:
+        bytes: 带版本标记的编码结果
+    """
+    return VERSION_TAG + orjson.dumps(record)
+
+def _upgrade_v1(record):
+    """把版本 1 记录中的 ISO-8601 时间转换为时间戳"""
+    if isinstance(record, list):
+        return [_upgrade_v1(item) for item in record]
+    if isinstance(record, dict):
+        for field in TIMESTAMP_FIELDS:
+            if isinstance(record.get(field), str):
+                record[field] = to_timestamp(record[field])
+    return record
+
+def decode(data):
+    """
+    解码任意版本的记录
+
+    参数:
+        data (bytes | None): Redis 中读取的原始值
+
+    返回:
+        dict | list | None: 解码后的记录，时间字段均为整数时间戳
+    """
+    if data is None:
+        return None
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+
+    version = data[0]
+    if version == FORMAT_VERSION:
+        return orjson.loads(data[1:])
+    if data[:1] in (b'{', b'['):
+        return _upgrade_v1(orjson.loads(data))
+    raise ValueError(f"不支持的记录版本: {version}")
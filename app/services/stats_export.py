@@ -0,0 +1,157 @@
+"""
+统计导出服务
+"""
+import asyncio
+import csv
+import io
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, timedelta
+
+from app.config.settings import CHART_CACHE_TTL_SECONDS, STATS_RETENTION_DAYS
+from app.services import database as db
+from app.utils import chart_renderer
+
+# 图表渲染工作进程，首次使用时创建
+_chart_executor = None
+
+CSV_HEADER = ['date', 'total_invites', 'admin_invites', 'user_invites', 'unique_users', 'period']
+
+def daily_export_start(start_date):
+    """
+    返回按天导出的起始日期
+
+    每日统计只保留 STATS_RETENTION_DAYS 天，更早的日期从周汇总导出；
+    为避免同一周既按周又按天计入，按天导出从保留期内的第一个周一开始。
+    """
+    oldest_date = date.today() - timedelta(days=STATS_RETENTION_DAYS - 1)
+    if start_date >= oldest_date:
+        return start_date
+    return oldest_date + timedelta(days=-oldest_date.weekday() % 7)
+
+def iter_stats_csv(start_date, end_date):
+    """
+    逐行生成指定日期范围内的统计 CSV
+
+    保留期内的日期逐日导出（period 为 day），更早的日期逐周导出（period 为 week，
+    date 为该周的周一），首尾两周为整周的数据。
+
+    参数:
+        start_date (date): 开始日期（含）
+        end_date (date): 结束日期（含）
+
+    返回:
+        generator: 每次产出一行 CSV 文本
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def flush():
+        line = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return line
+
+    writer.writerow(CSV_HEADER)
+    yield flush()
+
+    daily_start = daily_export_start(start_date)
+    rows = []
+    if start_date < daily_start:
+        weeks_end = min(end_date, daily_start - timedelta(days=1))
+        rows.append(('week', db.iter_weekly_stats(start_date, weeks_end)))
+    rows.append(('day', db.iter_daily_stats(max(start_date, daily_start), end_date)))
+
+    for period, stats in rows:
+        for item in stats:
+            writer.writerow([
+                item['date'],
+                item['total_invites'],
+                item['admin_invites'],
+                item['user_invites'],
+                len(item['users']),
+                period
+            ])
+            yield flush()
+
+def write_stats_csv(start_date, end_date, file):
+    """
+    把统计 CSV 逐行写入二进制文件对象
+
+    返回:
+        int: 写入的数据行数（不含表头）
+    """
+    rows = -1
+    for line in iter_stats_csv(start_date, end_date):
+        file.write(line.encode('utf-8'))
+        rows += 1
+    file.seek(0)
+    return rows
+
+def _get_chart_executor():
+    """获取图表渲染工作进程池"""
+    global _chart_executor
+    if _chart_executor is None:
+        _chart_executor = ProcessPoolExecutor(max_workers=1)
+    return _chart_executor
+
+def shutdown_chart_executor():
+    """关闭图表渲染工作进程池"""
+    global _chart_executor
+    if _chart_executor is not None:
+        _chart_executor.shutdown(wait=False, cancel_futures=True)
+        _chart_executor = None
+
+def load_period_stats(period, count):
+    """
+    获取最近几个周期的统计信息
+
+    参数:
+        period (str): 'day'、'week' 或 'month'
+        count (int): 周期数量
+
+    返回:
+        list: 统计数据，按时间倒序
+    """
+    if period == 'day':
+        return db.get_invite_stats(count)
+    return db.get_rollup_stats(period, count)
+
+async def get_trend_chart(period, count):
+    """
+    获取统计趋势图，优先使用缓存
+
+    缓存键由统计范围、当天日期和统计版本号组成，
+    有新的邀请码统计或跨天后旧图表自然失效。
+    渲染在独立进程中执行，不会阻塞事件循环。
+
+    参数:
+        period (str): 'day'、'week' 或 'month'
+        count (int): 周期数量
+
+    返回:
+        bytes: PNG 图片内容
+    """
+    version = await asyncio.to_thread(db.get_stats_version)
+    today = date.today().isoformat()
+    cache_key = f"{period}:{count}:{today}:{version}"
+
+    image = await asyncio.to_thread(db.get_cached_chart, cache_key)
+    if image:
+        return image
+
+    stats = await asyncio.to_thread(load_period_stats, period, count)
+    ordered = list(reversed(stats))
+    labels = [item.get('date') or item.get('period') for item in ordered]
+    admin_counts = [item['admin_invites'] for item in ordered]
+    user_counts = [item['user_invites'] for item in ordered]
+    title = f"Invites, last {count} {period}s"
+
+    loop = asyncio.get_running_loop()
+    image = await loop.run_in_executor(
+        _get_chart_executor(),
+        chart_renderer.render_trend_chart,
+        title, labels, admin_counts, user_counts
+    )
+
+    await asyncio.to_thread(db.cache_chart, cache_key, image, CHART_CACHE_TTL_SECONDS)
+    return image
@@ -0,0 +1,119 @@
+"""
+验证码限流服务
+
+在生成验证码图片和校验验证码之前检查限流，超限的请求不会触发任何渲染：
+    - 每个用户获取验证码的冷却时间
+    - 全局令牌桶，限制所有用户合计的验证码生成和校验速率
+    - 短时间内多次验证失败后临时封禁
+"""
+from app.config.settings import (
+    THROTTLE_PREFIX, CAPTCHA_COOLDOWN_SECONDS, CAPTCHA_ISSUE_RATE, CAPTCHA_ISSUE_BURST,
+    CAPTCHA_VERIFY_RATE, CAPTCHA_VERIFY_BURST, CAPTCHA_MAX_FAILURES,
+    CAPTCHA_FAILURE_WINDOW_SECONDS, CAPTCHA_BAN_SECONDS
+)
+from app.services import database as db
+
+# 限流结果
+BANNED = 'banned'
+COOLDOWN = 'cooldown'
+BUSY = 'busy'
+
+# 令牌桶：按经过的时间补充令牌，足够时取走一个；使用 Redis 服务器时间，多实例共享同一个桶
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return allowed
+"""
+
+def cooldown_key(user_id):
+    return f"{THROTTLE_PREFIX}cooldown:{db._tag(user_id)}"
+
+def failures_key(user_id):
+    return f"{THROTTLE_PREFIX}failures:{db._tag(user_id)}"
+
+def ban_key(user_id):
+    return f"{THROTTLE_PREFIX}ban:{db._tag(user_id)}"
+
+def bucket_key(name):
+    return f"{THROTTLE_PREFIX}bucket:{name}"
+
+def take_token(name, rate, burst):
+    """从全局令牌桶中取走一个令牌，返回是否成功"""
+    return bool(db.get_redis().eval(TOKEN_BUCKET_SCRIPT, 1, bucket_key(name), rate, burst))
+
+def ban_remaining(user_id):
+    """返回用户剩余的封禁时间（秒），未被封禁时返回 0"""
+    return max(db.get_redis().ttl(ban_key(user_id)), 0)
+
+def check_captcha_issue(user_id):
+    """
+    检查用户是否可以获取新的验证码，通过时开始计算冷却时间
+
+    返回:
+        tuple: (限流结果, 需要等待的秒数)，允许时限流结果为 None
+    """
+    remaining = ban_remaining(user_id)
+    if remaining:
+        return BANNED, remaining
+
+    if not db.get_redis().set(cooldown_key(user_id), 1, nx=True, ex=CAPTCHA_COOLDOWN_SECONDS):
+        return COOLDOWN, max(db.get_redis().ttl(cooldown_key(user_id)), 1)
+
+    if not take_token('captcha_issue', CAPTCHA_ISSUE_RATE, CAPTCHA_ISSUE_BURST):
+        # 全局繁忙时不占用用户的冷却时间，让用户可以稍后立即重试
+        db.get_redis().delete(cooldown_key(user_id))
+        return BUSY, 1
+
+    return None, 0
+
+def check_captcha_verify(user_id):
+    """
+    检查用户是否可以提交验证码
+
+    返回:
+        tuple: (限流结果, 需要等待的秒数)，允许时限流结果为 None
+    """
+    remaining = ban_remaining(user_id)
+    if remaining:
+        return BANNED, remaining
+
+    if not take_token('captcha_verify', CAPTCHA_VERIFY_RATE, CAPTCHA_VERIFY_BURST):
+        return BUSY, 1
+
+    return None, 0
+
+def record_captcha_failure(user_id):
+    """
+    记录一次验证失败，达到上限时封禁用户
+
+    返回:
+        bool: 用户是否因此被封禁
+    """
+    key = failures_key(user_id)
+    failures = db.get_redis().incr(key)
+    if failures == 1:
+        db.get_redis().expire(key, CAPTCHA_FAILURE_WINDOW_SECONDS)
+
+    if failures < CAPTCHA_MAX_FAILURES:
+        return False
+
+    db.get_redis().set(ban_key(user_id), 1, ex=CAPTCHA_BAN_SECONDS)
+    db.get_redis().delete(key)
+    return True
+
+def reset_captcha_failures(user_id):
+    """验证成功后清除失败计数"""
+    db.get_redis().delete(failures_key(user_id))
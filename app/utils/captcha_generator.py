@@ -1,11 +1,12 @@
 """
 验证码生成器 - 优化版
+
+PIL 和 captcha 库在首次生成验证码时才导入，避免拖慢启动，
+可以在启动后调用 warm_up 在后台提前加载。
 """
 import random
 import string
 from io import BytesIO
-from PIL import Image, ImageDraw, ImageFont, ImageFilter
-from captcha.image import ImageCaptcha
 
 def generate_captcha_text(length=4):
     """
@@ -32,6 +33,8 @@ def generate_captcha_image_with_custom_options(text):
     返回:
         BytesIO: 包含验证码图片的字节流
     """
+    from PIL import Image, ImageDraw, ImageFont, ImageFilter
+    
     # 设置图片尺寸和背景色
     width = 160
     height = 60
@@ -94,6 +97,8 @@ def generate_captcha_image_with_library(text):
     返回:
         BytesIO: 包含验证码图片的字节流
     """
+    from captcha.image import ImageCaptcha
+    
     # 创建验证码生成器，使用更大的尺寸和更清晰的字体
     image = ImageCaptcha(
         width=160,         # 适当的宽度
@@ -139,4 +144,13 @@ def generate_captcha():
     """
     captcha_text = generate_captcha_text()
     captcha_image = generate_captcha_image(captcha_text)
-    return captcha_text, captcha_image 
\ No newline at end of file
+    return captcha_text, captcha_image
+
+def warm_up():
+    """
+    预热验证码生成器：导入 PIL、captcha 并渲染一张验证码，
+    使首个用户请求不必承担导入和字体加载的开销
+    """
+    # 同时加载回退方法使用的 captcha 库
+    import captcha.image
+    generate_captcha()
@@ -0,0 +1,90 @@
+"""
+统计图表渲染器
+"""
+from io import BytesIO
+
+# 图表尺寸与配色
+CHART_WIDTH = 800
+CHART_HEIGHT = 400
+MARGIN_LEFT = 60
+MARGIN_RIGHT = 20
+MARGIN_TOP = 40
+MARGIN_BOTTOM = 60
+BG_COLOR = (255, 255, 255)
+AXIS_COLOR = (80, 80, 80)
+GRID_COLOR = (230, 230, 230)
+ADMIN_COLOR = (230, 140, 40)
+USER_COLOR = (40, 110, 200)
+
+def render_trend_chart(title, labels, admin_counts, user_counts):
+    """
+    渲染邀请码趋势图（堆叠柱状图）
+
+    该函数只接收普通数据并返回字节，可以直接在工作进程中执行。
+    默认字体不支持中文，图中文字使用英文。PIL 在渲染时才导入，不影响主进程启动。
+
+    参数:
+        title (str): 图表标题
+        labels (list): 横轴标签，按时间正序
+        admin_counts (list): 每个标签对应的管理员邀请码数量
+        user_counts (list): 每个标签对应的普通用户邀请码数量
+
+    返回:
+        bytes: PNG 图片内容
+    """
+    from PIL import Image, ImageDraw, ImageFont
+
+    image = Image.new('RGB', (CHART_WIDTH, CHART_HEIGHT), BG_COLOR)
+    draw = ImageDraw.Draw(image)
+    font = ImageFont.load_default()
+
+    plot_left = MARGIN_LEFT
+    plot_right = CHART_WIDTH - MARGIN_RIGHT
+    plot_top = MARGIN_TOP
+    plot_bottom = CHART_HEIGHT - MARGIN_BOTTOM
+    plot_height = plot_bottom - plot_top
+
+    totals = [admin + user for admin, user in zip(admin_counts, user_counts)]
+    max_total = max(totals + [1])
+
+    # 标题与图例
+    draw.text((plot_left, 12), title, font=font, fill=AXIS_COLOR)
+    draw.rectangle([plot_right - 150, 14, plot_right - 140, 24], fill=USER_COLOR)
+    draw.text((plot_right - 135, 12), 'user', font=font, fill=AXIS_COLOR)
+    draw.rectangle([plot_right - 80, 14, plot_right - 70, 24], fill=ADMIN_COLOR)
+    draw.text((plot_right - 65, 12), 'admin', font=font, fill=AXIS_COLOR)
+
+    # 网格线与纵轴刻度
+    for i in range(5):
+        value = max_total * i / 4
+        y = plot_bottom - plot_height * i / 4
+        draw.line([(plot_left, y), (plot_right, y)], fill=GRID_COLOR)
+        draw.text((8, y - 6), f"{value:.0f}", font=font, fill=AXIS_COLOR)
+
+    # 柱状图
+    if labels:
+        slot_width = (plot_right - plot_left) / len(labels)
+        bar_width = max(1, slot_width * 0.7)
+        label_step = max(1, len(labels) // 10)
+
+        for i, (label, admin, user) in enumerate(zip(labels, admin_counts, user_counts)):
+            x0 = plot_left + slot_width * i + (slot_width - bar_width) / 2
+            x1 = x0 + bar_width
+            user_top = plot_bottom - plot_height * user / max_total
+            admin_top = user_top - plot_height * admin / max_total
+            if user:
+                draw.rectangle([x0, user_top, x1, plot_bottom], fill=USER_COLOR)
+            if admin:
+                draw.rectangle([x0, admin_top, x1, user_top], fill=ADMIN_COLOR)
+
+            # 标签过多时只显示部分横轴标签
+            if i % label_step == 0:
+                draw.text((x0, plot_bottom + 8), label, font=font, fill=AXIS_COLOR)
+
+    # 坐标轴
+    draw.line([(plot_left, plot_top), (plot_left, plot_bottom)], fill=AXIS_COLOR)
+    draw.line([(plot_left, plot_bottom), (plot_right, plot_bottom)], fill=AXIS_COLOR)
+
+    image_bytes = BytesIO()
+    image.save(image_bytes, format='PNG')
+    return image_bytes.getvalue()
@@ -0,0 +1,42 @@
+"""
+运行状态与优雅停机工具
+"""
+import asyncio
+import functools
+import time
+
+# 正在执行的处理器数量
+INFLIGHT_HANDLERS = 0
+
+def tracked(callback):
+    """
+    包装处理器回调，统计正在执行的处理器数量，停机时据此等待处理完成
+    """
+    @functools.wraps(callback)
+    async def wrapper(*args, **kwargs):
+        global INFLIGHT_HANDLERS
+        INFLIGHT_HANDLERS += 1
+        try:
+            return await callback(*args, **kwargs)
+        finally:
+            INFLIGHT_HANDLERS -= 1
+    return wrapper
+
+async def drain(update_queue, timeout, poll_interval=0.1):
+    """
+    等待已接收的更新和正在执行的处理器全部完成
+
+    参数:
+        update_queue (asyncio.Queue): 应用的更新队列
+        timeout (float): 最长等待时间（秒）
+        poll_interval (float): 检查间隔（秒）
+
+    返回:
+        bool: 是否在截止时间前全部完成
+    """
+    deadline = time.monotonic() + timeout
+    while update_queue.qsize() > 0 or INFLIGHT_HANDLERS > 0:
+        if time.monotonic() >= deadline:
+            return False
+        await asyncio.sleep(poll_interval)
+    return True
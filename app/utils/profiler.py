@@ -0,0 +1,124 @@
+"""
+运行诊断工具
+
+采样分析器：在独立线程中定期读取所有线程（包括事件循环线程和工作线程）的调用栈，
+开销只取决于采样间隔，不需要修改或重启被分析的代码。结果可以输出为热点列表，
+以及 flamegraph.pl、speedscope 等工具可以直接读取的折叠栈格式。
+
+事件循环延迟监控：定期测量 asyncio.sleep 实际唤醒时间与预期时间的差值，
+超过阈值时记录日志，用于发现阻塞事件循环的同步调用。
+"""
+import asyncio
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+from loguru import logger
+
+# 线程空闲等待时所在的函数，计算热点时排除这些样本
+IDLE_FRAMES = {
+    ('selectors.py', 'select'),
+    ('threading.py', 'wait'),
+    ('queue.py', 'get'),
+    ('thread.py', '_worker'),
+}
+
+# 事件循环延迟统计，由 monitor_loop_lag 更新
+LOOP_LAG = {'last_ms': 0.0, 'max_ms': 0.0, 'stalls': 0}
+
+# 进行中的测量窗口，每个窗口单独记录期间的最大延迟和阻塞次数，不影响 LOOP_LAG
+LAG_WINDOWS = []
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+def sample_stacks(duration, interval=0.01):
+    """
+    在当前线程中对其他所有线程采样
+
+    参数:
+        duration (float): 采样时长（秒）
+        interval (float): 采样间隔（秒）
+
+    返回:
+        tuple: (折叠栈 -> 样本数的 Counter, 采样轮数)
+    """
+    own_thread = threading.get_ident()
+    stacks = Counter()
+    rounds = 0
+    deadline = time.monotonic() + duration
+
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_thread:
+                continue
+            leaf = (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name)
+            if leaf in IDLE_FRAMES:
+                continue
+
+            frames = []
+            while frame is not None:
+                frames.append(_frame_label(frame))
+                frame = frame.f_back
+            frames.append(names.get(thread_id, str(thread_id)))
+            stacks[';'.join(reversed(frames))] += 1
+        rounds += 1
+        time.sleep(interval)
+
+    return stacks, rounds
+
+def hot_spots(stacks, limit=15):
+    """
+    统计热点函数
+
+    返回:
+        list: [(函数位置, 自身样本数, 包含子调用的样本数)]，按自身样本数降序
+    """
+    own, total = Counter(), Counter()
+    for stack, count in stacks.items():
+        # 第一项为线程名，最后一项为正在执行的函数
+        frames = stack.split(';')[1:]
+        own[frames[-1]] += count
+        for location in set(frames):
+            total[location] += count
+    return [(location, count, total[location]) for location, count in own.most_common(limit)]
+
+def format_folded(stacks):
+    """把折叠栈输出为 flamegraph.pl 使用的文本格式"""
+    return ''.join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+def start_lag_window():
+    """开始一个测量窗口，返回记录窗口内最大延迟（max_ms）和阻塞次数（stalls）的字典"""
+    window = {'max_ms': 0.0, 'stalls': 0}
+    LAG_WINDOWS.append(window)
+    return window
+
+def end_lag_window(window):
+    """结束测量窗口"""
+    if window in LAG_WINDOWS:
+        LAG_WINDOWS.remove(window)
+
+async def monitor_loop_lag(threshold_ms, interval=0.5):
+    """
+    持续测量事件循环延迟，超过阈值时记录日志
+
+    参数:
+        threshold_ms (float): 记录日志的延迟阈值（毫秒）
+        interval (float): 测量间隔（秒）
+    """
+    while True:
+        start = time.monotonic()
+        await asyncio.sleep(interval)
+        lag_ms = max((time.monotonic() - start - interval) * 1000, 0.0)
+        LOOP_LAG['last_ms'] = lag_ms
+        stalled = lag_ms > threshold_ms
+        for stats in (LOOP_LAG, *LAG_WINDOWS):
+            stats['max_ms'] = max(stats['max_ms'], lag_ms)
+            if stalled:
+                stats['stalls'] += 1
+        if stalled:
+            logger.warning(f"事件循环阻塞 {lag_ms:.0f} ms")
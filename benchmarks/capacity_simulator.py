@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+"""
+Redis 容量规划模拟器
+
+通过 app.services.database 的真实接口写入模拟用户和邀请码历史，分阶段增加用户数，
+每个阶段结束后统计：
+    - 各类键的数量和内存占用（MEMORY USAGE，不支持时使用 DUMP 长度近似）
+    - 各操作的延迟、Redis 命令数和往返次数
+    - 内存随用户数增长的曲线
+
+默认使用 fakeredis（需要 pip install fakeredis），延迟数字只用于比较不同的键布局；
+指定 --redis-url 时连接本地 Redis，为避免覆盖数据，目标数据库必须为空。
+
+用法:
+    python benchmarks/capacity_simulator.py [--users 1000] [--invites 5] [--steps 5]
+        [--redis-url redis://localhost:6379/15] [--invite-rate 10] [--output result.json]
+"""
+import argparse
+import json
+import os
+import random
+import re
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.config import settings
+from app.services import database as db
+from app.services import events
+
+WEEK_SECONDS = 7 * 24 * 60 * 60
+
+# 键类型，按前缀从长到短匹配
+KEY_TYPES = [
+    ('stats:week', settings.STATS_WEEKLY_PREFIX),
+    ('stats:month', settings.STATS_MONTHLY_PREFIX),
+    ('stats:rolled', settings.STATS_ROLLUP_MARK_PREFIX),
+    ('stats:activity', settings.STATS_ACTIVITY_PREFIX),
+    ('stats:day', settings.STATS_PREFIX),
+    ('user', settings.USER_PREFIX),
+    ('captcha', settings.CAPTCHA_PREFIX),
+    ('invite_code', settings.INVITE_CODE_PREFIX),
+    ('invite_archive', settings.INVITE_ARCHIVE_PREFIX),
+    ('chart', settings.CHART_CACHE_PREFIX),
+    ('pending_lock', settings.PENDING_LOCK_PREFIX),
+    ('idem', settings.IDEMPOTENCY_PREFIX),
+    ('invite_lock', settings.INVITE_LOCK_PREFIX),
+    ('throttle', settings.THROTTLE_PREFIX),
+    ('event_done', settings.EVENT_PROCESSED_PREFIX),
+]
+EXACT_KEYS = {
+    settings.PENDING_INVITES_KEY: 'pending_invites',
+    settings.EVENTS_STREAM_KEY: 'events',
+    settings.ADMINS_KEY: 'admins',
+}
+MONTH_SUFFIX = re.compile(r':\d{4}-\d{2}$')
+
+class CommandCounter:
+    """
+    在连接层统计发往 Redis 的命令数和往返次数
+
+    替换连接池的连接类，WATCH、事务中的 MULTI/EXEC、管道和脚本调用都按实际发送的命令计数，
+    每次向套接字发送一批命令计为一次往返。
+    """
+
+    def __init__(self, client):
+        self.commands = 0
+        self.round_trips = 0
+        counter = self
+        pool = client.connection_pool
+
+        class CountingConnection(pool.connection_class):
+            def send_command(self, *args, **kwargs):
+                counter.commands += 1
+                return super().send_command(*args, **kwargs)
+
+            def pack_commands(self, commands):
+                counter.commands += len(commands)
+                return super().pack_commands(commands)
+
+            def send_packed_command(self, command, check_health=True):
+                counter.round_trips += 1
+                return super().send_packed_command(command, check_health)
+
+        # 之后新建的连接使用计数的连接类
+        pool.disconnect()
+        pool.connection_class = CountingConnection
+
+class OperationStats:
+    """按操作名称记录延迟和命令数"""
+
+    def __init__(self, counter):
+        self.counter = counter
+        self.samples = {}
+
+    def measure(self, name, func, *args, **kwargs):
+        commands, round_trips = self.counter.commands, self.counter.round_trips
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        self.samples.setdefault(name, []).append((
+            elapsed,
+            self.counter.commands - commands,
+            self.counter.round_trips - round_trips
+        ))
+        return result
+
+    def summary(self):
+        rows = {}
+        for name, samples in self.samples.items():
+            latencies = sorted(sample[0] * 1e6 for sample in samples)
+            rows[name] = {
+                'calls': len(samples),
+                'mean_us': statistics.fmean(latencies),
+                'p50_us': latencies[len(latencies) // 2],
+                'p95_us': latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)],
+                'commands': statistics.fmean(sample[1] for sample in samples),
+                'round_trips': statistics.fmean(sample[2] for sample in samples)
+            }
+        return rows
+
+def key_type(key):
+    """按键名判断键类型"""
+    if key in EXACT_KEYS:
+        return EXACT_KEYS[key]
+    if key == settings.STATS_VERSION_KEY:
+        return 'stats:version'
+    for name, prefix in KEY_TYPES:
+        if key.startswith(prefix):
+            if name == 'invite_archive':
+                return 'invite_archive:month' if MONTH_SUFFIX.search(key) else 'invite_archive:index'
+            return name
+    return 'other'
+
+def key_memory(client, key):
+    """单个键的内存占用（字节），不支持 MEMORY USAGE 时使用 DUMP 长度近似"""
+    try:
+        return client.memory_usage(key, samples=0) or 0
+    except Exception:
+        dumped = client.dump(key)
+        return len(key) + (len(dumped) if dumped else 0)
+
+def measure_memory(client, sample_keys):
+    """
+    统计各类键的数量和内存占用，每类最多测量 sample_keys 个键，其余按平均值估算
+
+    返回:
+        dict: 键类型 -> {'keys': 数量, 'bytes': 估算字节数}
+    """
+    keys_by_type = {}
+    for key in client.scan_iter(count=1000):
+        key = key.decode('utf-8')
+        keys_by_type.setdefault(key_type(key), []).append(key)
+
+    result = {}
+    for name, keys in sorted(keys_by_type.items()):
+        sample = keys if len(keys) <= sample_keys else random.sample(keys, sample_keys)
+        sampled_bytes = sum(key_memory(client, key) for key in sample)
+        result[name] = {
+            'keys': len(keys),
+            'bytes': int(sampled_bytes * len(keys) / len(sample))
+        }
+    return result
+
+def simulate_invite(ops, user_id, invite_code, requested_at, is_admin=False):
+    """按 process_pending_invite 的顺序执行一次邀请码签发的数据库操作"""
+    token = f"sim:{user_id}:{invite_code}"
+    ops.measure('begin_idempotent_request', db.begin_idempotent_request, token)
+    lock = ops.measure('acquire_invite_lock', db.acquire_invite_lock, user_id)
+    pending = {'user_id': user_id, 'chat_id': user_id, 'is_admin': is_admin,
+               'state': 'accepted', 'attempts': 0, 'updated_at': requested_at}
+    ops.measure('save_pending_invite', db.save_pending_invite, token, pending)
+    pending.update(state='minted', invite_data={'code': invite_code, 'expires_at': None})
+    ops.measure('save_pending_invite', db.save_pending_invite, token, pending)
+    ops.measure('record_invite_code_request', db.record_invite_code_request,
+                user_id, invite_code, None if is_admin else settings.INVITE_CODE_EXPIRY_DAYS,
+                requested_at=requested_at)
+    pending.update(state='recorded')
+    ops.measure('save_pending_invite', db.save_pending_invite, token, pending)
+    ops.measure('complete_idempotent_request', db.complete_idempotent_request, token,
+                {'invite_data': pending['invite_data'], 'is_admin': is_admin})
+    ops.measure('delete_pending_invite', db.delete_pending_invite, token)
+    if lock:
+        ops.measure('release_invite_lock', db.release_invite_lock, user_id, lock)
+
+def populate(ops, first_user, count, invites_per_user, now):
+    """写入一批模拟用户：注册、验证码、按周分布的邀请码历史"""
+    for user_id in range(first_user, first_user + count):
+        ops.measure('save_user', db.save_user, user_id, f"user{user_id}", "Sim")
+        ops.measure('record_event', db.record_event, 'start', user_id)
+        ops.measure('save_captcha', db.save_captcha, user_id, 'ABCD')
+        ops.measure('can_request_invite_code', db.can_request_invite_code, user_id)
+        # 每周一个邀请码，最近的一个在本周；超出 STATS_RETENTION_DAYS 的日期与实际部署一样
+        # 只计入周、月汇总，不会产生每日统计键
+        for i in range(invites_per_user):
+            requested_at = int(now - (invites_per_user - 1 - i) * WEEK_SECONDS - random.randint(0, 86400))
+            simulate_invite(ops, user_id, f"{user_id:x}-{i}", requested_at)
+
+def consume_events(ops):
+    """处理事件流中的全部事件"""
+    db.ensure_event_group()
+    while ops.measure('consume_events', events.consume_once, block_ms=1):
+        pass
+
+def sample_reads(ops, max_user, reads):
+    """对随机用户执行常见的只读查询"""
+    for _ in range(reads):
+        user_id = random.randint(1, max_user)
+        ops.measure('get_user_profile', db.get_user_profile, user_id)
+        ops.measure('get_user_invite_history', db.get_user_invite_history, user_id)
+    ops.measure('get_invite_stats', db.get_invite_stats, 7)
+
+def create_client(redis_url):
+    """创建 Redis 客户端，默认使用 fakeredis"""
+    if redis_url:
+        import redis
+
+        client = redis.from_url(redis_url)
+        if client.dbsize():
+            sys.exit(f"{redis_url} 不是空数据库，为避免覆盖数据请指定一个空的数据库")
+        return client
+
+    try:
+        import fakeredis
+    except ImportError:
+        sys.exit("未安装 fakeredis，请执行 pip install fakeredis，或使用 --redis-url 指定本地 Redis")
+    return fakeredis.FakeRedis()
+
+def format_bytes(value):
+    for unit in ('B', 'KiB', 'MiB'):
+        if value < 1024:
+            return f"{value:.1f} {unit}"
+        value /= 1024
+    return f"{value:.1f} GiB"
+
+def main():
+    parser = argparse.ArgumentParser(description='Redis 容量规划模拟器')
+    parser.add_argument('--users', type=int, default=1000, help='模拟的用户总数')
+    parser.add_argument('--invites', type=int, default=5, help='每个用户的邀请码数量（每周一个）')
+    parser.add_argument('--steps', type=int, default=5, help='分几个阶段增加用户，用于生成增长曲线')
+    parser.add_argument('--reads', type=int, default=200, help='每个阶段的随机只读查询次数')
+    parser.add_argument('--sample-keys', type=int, default=2000, help='每类键最多测量内存的键数')
+    parser.add_argument('--invite-rate', type=float, default=10, help='高峰期每秒签发的邀请码数，用于估算 Redis 负载')
+    parser.add_argument('--redis-url', help='本地 Redis 地址（必须为空数据库），默认使用 fakeredis')
+    parser.add_argument('--seed', type=int, default=0, help='随机数种子')
+    parser.add_argument('--output', help='把结果写入 JSON 文件，便于比较不同的键布局')
+    args = parser.parse_args()
+    for name in ('users', 'invites', 'steps', 'sample_keys'):
+        if getattr(args, name) < 1:
+            parser.error(f"--{name.replace('_', '-')} 必须大于 0")
+    if args.reads < 0:
+        parser.error("--reads 不能小于 0")
+
+    random.seed(args.seed)
+    client = create_client(args.redis_url)
+    counter = CommandCounter(client)
+    db.init_redis(client=client)
+
+    now = time.time()
+    ops = OperationStats(counter)
+    per_step = max(args.users // args.steps, 1)
+    growth = []
+    created = 0
+
+    print(f"{'用户数':>8}{'邀请码数':>10}{'键数':>10}{'内存':>14}{'每用户':>12}{'耗时 s':>10}")
+    while created < args.users:
+        batch = min(per_step, args.users - created)
+        step_start = time.perf_counter()
+        populate(ops, created + 1, batch, args.invites, now)
+        created += batch
+        consume_events(ops)
+        ops.measure('rollup_stats', db.rollup_stats)
+        sample_reads(ops, created, args.reads)
+        elapsed = time.perf_counter() - step_start
+
+        memory = measure_memory(client, args.sample_keys)
+        total_bytes = sum(item['bytes'] for item in memory.values())
+        total_keys = sum(item['keys'] for item in memory.values())
+        growth.append({'users': created, 'invites': created * args.invites, 'keys': total_keys,
+                       'bytes': total_bytes, 'seconds': elapsed})
+        print(f"{created:>8}{created * args.invites:>10}{total_keys:>10}"
+              f"{format_bytes(total_bytes):>14}{format_bytes(total_bytes / created):>12}{elapsed:>10.2f}")
+
+    print(f"\n各类键（{args.users} 个用户，每人 {args.invites} 个邀请码）:")
+    print(f"{'类型':<24}{'键数':>10}{'内存':>14}{'每键':>12}{'占比':>8}")
+    for name, item in sorted(memory.items(), key=lambda entry: -entry[1]['bytes']):
+        print(f"{name:<24}{item['keys']:>10}{format_bytes(item['bytes']):>14}"
+              f"{format_bytes(item['bytes'] / item['keys']):>12}{item['bytes'] * 100 / total_bytes:>7.1f}%")
+    print(f"注: idem、event_done 键分别在 {settings.IDEMPOTENCY_TTL_SECONDS}、"
+          f"{settings.EVENT_DEDUPE_TTL_SECONDS} 秒后过期，模拟中全部保留，实际占用会更低")
+
+    operations = ops.summary()
+    print(f"\n{'操作':<30}{'次数':>8}{'平均 μs':>10}{'p50 μs':>10}{'p95 μs':>10}{'命令':>8}{'往返':>8}")
+    for name, row in sorted(operations.items()):
+        print(f"{name:<30}{row['calls']:>8}{row['mean_us']:>10.1f}{row['p50_us']:>10.1f}"
+              f"{row['p95_us']:>10.1f}{row['commands']:>8.1f}{row['round_trips']:>8.1f}")
+
+    # 一次 /invite 的 Redis 负载：配额检查 + 签发流程 + 事件消费
+    invite_path = ['can_request_invite_code', 'begin_idempotent_request', 'acquire_invite_lock',
+                   'record_invite_code_request', 'complete_idempotent_request',
+                   'delete_pending_invite', 'release_invite_lock']
+    commands_per_invite = sum(operations[name]['commands'] for name in invite_path if name in operations)
+    commands_per_invite += 3 * operations['save_pending_invite']['commands']
+    # 每个用户一个 start 事件，每个邀请码一个 invite 事件
+    consumed = operations['consume_events']
+    commands_per_event = consumed['commands'] * consumed['calls'] / (args.users * (args.invites + 1))
+    print(f"\n每次签发约 {commands_per_invite:.1f} 条 Redis 命令，事件消费约 {commands_per_event:.1f} 条/事件；"
+          f"每秒 {args.invite_rate:g} 次签发约需 "
+          f"{args.invite_rate * (commands_per_invite + commands_per_event):.0f} 条命令/秒")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({
+                'users': args.users,
+                'invites_per_user': args.invites,
+                'redis': args.redis_url or 'fakeredis',
+                'hash_tags': settings.REDIS_HASH_TAGS,
+                'growth': growth,
+                'memory': memory,
+                'operations': operations,
+                'commands_per_invite': commands_per_invite,
+                'commands_per_event': commands_per_event
+            }, f, ensure_ascii=False, indent=2)
+        print(f"结果已写入 {args.output}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+记录序列化基准测试
+
+对比旧格式（json + ISO-8601 时间字符串）与当前格式（版本标记 + orjson + 整数时间戳）
+在用户记录、邀请码历史和每日统计上的编码、解码耗时以及每条记录的字节数。
+
+用法:
+    python benchmarks/serialization_benchmark.py [--history 20] [--iterations 20000]
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.services import serialization
+
+def sample_records(history_length):
+    """生成旧格式和当前格式的示例记录"""
+    now = datetime.now()
+    user_v1 = {
+        'username': 'example_user',
+        'first_name': 'Example',
+        'last_name': None,
+        'registered_at': now.isoformat(),
+        'is_admin': False
+    }
+    history_v1 = [
+        {
+            'invite_code': f"{i:08x}abcd",
+            'requested_at': (now - timedelta(days=7 * i)).isoformat(),
+            'expires_at': (now - timedelta(days=7 * i - 7)).isoformat(),
+            'is_admin_generated': False
+        }
+        for i in range(history_length)
+    ]
+    stats = {
+        'total_invites': 42,
+        'admin_invites': 2,
+        'user_invites': 40,
+        'users': {str(100000000 + i): 1 for i in range(40)}
+    }
+    return {
+        'user': (user_v1, serialization.decode(json.dumps(user_v1).encode())),
+        'history': (history_v1, serialization.decode(json.dumps(history_v1).encode())),
+        'stats': (stats, stats)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='记录序列化基准测试')
+    parser.add_argument('--history', type=int, default=20, help='每个用户的历史记录条数')
+    parser.add_argument('--iterations', type=int, default=20000, help='每项测量的执行次数')
+    args = parser.parse_args()
+
+    print(f"{'记录':<8}{'格式':<6}{'字节':>8}{'编码 μs':>12}{'解码 μs':>12}")
+    for name, (record_v1, record_v2) in sample_records(args.history).items():
+        data_v1 = json.dumps(record_v1).encode('utf-8')
+        data_v2 = serialization.encode(record_v2)
+
+        rows = [
+            ('v1', data_v1,
+             lambda: json.dumps(record_v1).encode('utf-8'),
+             lambda: json.loads(data_v1)),
+            ('v2', data_v2,
+             lambda: serialization.encode(record_v2),
+             lambda: serialization.decode(data_v2)),
+        ]
+        for version, data, encode, decode in rows:
+            encode_us = timeit.timeit(encode, number=args.iterations) / args.iterations * 1e6
+            decode_us = timeit.timeit(decode, number=args.iterations) / args.iterations * 1e6
+            print(f"{name:<8}{version:<6}{len(data):>8}{encode_us:>12.2f}{decode_us:>12.2f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+启动耗时基准测试
+
+在全新的子进程中多次执行 "导入 app.bot 并调用 create_application"，
+统计耗时并检查 PIL、captcha 是否被提前导入。
+
+用法:
+    python benchmarks/startup_benchmark.py [--runs 10]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 子进程中执行的代码：分别测量导入和工厂调用耗时
+CHILD_CODE = """
+import json, sys, time
+start = time.perf_counter()
+import app.bot
+imported = time.perf_counter()
+app.bot.create_application(token='123456:benchmark', configure_logging=False)
+created = time.perf_counter()
+print(json.dumps({
+    'import_ms': (imported - start) * 1000,
+    'factory_ms': (created - imported) * 1000,
+    'pil_loaded': 'PIL.Image' in sys.modules,
+    'captcha_loaded': 'captcha.image' in sys.modules,
+}))
+"""
+
+def run_once():
+    """在新进程中执行一次启动并返回测量结果"""
+    env = dict(os.environ, PYTHONPATH=PROJECT_ROOT)
+    env.setdefault('TELEGRAM_BOT_TOKEN', '123456:benchmark')
+    env.setdefault('MISSKEY_API_URL', 'https://misskey.example.com')
+    output = subprocess.run(
+        [sys.executable, '-c', CHILD_CODE],
+        cwd=PROJECT_ROOT, env=env, capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description='测量机器人启动耗时')
+    parser.add_argument('--runs', type=int, default=10, help='测量次数')
+    args = parser.parse_args()
+
+    # 预热一次，让字节码缓存生效
+    run_once()
+    results = [run_once() for _ in range(args.runs)]
+
+    for key in ('import_ms', 'factory_ms'):
+        values = [result[key] for result in results]
+        print(f"{key:>10}: 中位数 {statistics.median(values):8.1f} ms  "
+              f"最小 {min(values):8.1f} ms  最大 {max(values):8.1f} ms")
+
+    total = [result['import_ms'] + result['factory_ms'] for result in results]
+    print(f"{'total_ms':>10}: 中位数 {statistics.median(total):8.1f} ms")
+    print(f"启动后已导入 PIL: {any(result['pil_loaded'] for result in results)}")
+    print(f"启动后已导入 captcha: {any(result['captcha_loaded'] for result in results)}")
+
+if __name__ == '__main__':
+    main()